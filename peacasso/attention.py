@@ -0,0 +1,139 @@
+# memory aware attention slicing. The slice size is chosen per request from the
+# size of the attention scores and the free memory, and applied through a
+# context variable instead of unet.set_attention_slice, which changes the
+# shared model for every request.
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+import torch
+
+from diffusers.models.attention import CrossAttention
+
+
+_UNSET = object()
+_slice_size_override: ContextVar = ContextVar("peacasso_attention_slice", default=_UNSET)
+
+# share of the free memory the attention scores may use
+ATTENTION_MEMORY_FRACTION = 0.5
+
+
+class PlannedCrossAttention(CrossAttention):
+    """CrossAttention that takes its slice size from the running request"""
+
+    @property
+    def _slice_size(self):
+        slice_size = _slice_size_override.get()
+        if slice_size is _UNSET:
+            return self.__dict__.get("_slice_size")
+        return slice_size
+
+    @_slice_size.setter
+    def _slice_size(self, value):
+        self.__dict__["_slice_size"] = value
+
+
+def apply_attention_planning(unet: torch.nn.Module) -> int:
+    """Patch the attention layers of the UNet, returns the number of patched layers"""
+    patched = 0
+    for module in unet.modules():
+        if type(module) is CrossAttention:
+            module.__class__ = PlannedCrossAttention
+            patched += 1
+    return patched
+
+
+@contextmanager
+def attention_slicing(slice_size: Optional[int]):
+    """Use `slice_size` (None for no slicing) in the patched layers for the duration of the block"""
+    token = _slice_size_override.set(slice_size)
+    try:
+        yield
+    finally:
+        _slice_size_override.reset(token)
+
+
+def available_memory(device: Union[str, torch.device]) -> Optional[int]:
+    """Free memory in bytes on `device`, PEACASSO_ATTENTION_MEMORY_MB overrides it"""
+    if os.environ.get("PEACASSO_ATTENTION_MEMORY_MB"):
+        return int(os.environ["PEACASSO_ATTENTION_MEMORY_MB"]) * 2**20
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class AttentionPlan(NamedTuple):
+    slice_size: Optional[int]
+    estimated_bytes: int
+    budget_bytes: Optional[int]
+
+    def to_dict(self):
+        return self._asdict()
+
+
+class AttentionPlanner:
+    """Picks the largest attention slice that fits the memory budget.
+    Decisions are cached per (batch, latent size, dtype, device)."""
+
+    def __init__(self, unet: torch.nn.Module, memory_fraction: float = ATTENTION_MEMORY_FRACTION):
+        self.heads = unet.config.attention_head_dim
+        self.memory_fraction = memory_fraction
+        self.plans: Dict[Tuple, AttentionPlan] = {}
+        self.lock = threading.Lock()
+
+    def estimate(self, rows: int, tokens: int, dtype: torch.dtype) -> int:
+        """Bytes of the largest attention (the full resolution self attention),
+        scores and their softmax are alive at the same time"""
+        itemsize = torch.tensor([], dtype=dtype).element_size()
+        return 2 * rows * tokens * tokens * itemsize
+
+    def _auto(self, batch_size, height, width, dtype, device) -> AttentionPlan:
+        tokens = (height // 8) * (width // 8)
+        rows = batch_size * self.heads
+        memory = available_memory(device)
+        budget = int(memory * self.memory_fraction) if memory is not None else None
+        # slice sizes have to divide the number of heads
+        candidates = [None] + [
+            s for s in range(self.heads // 2, 0, -1) if self.heads % s == 0
+        ]
+        for slice_size in candidates:
+            estimated = self.estimate(slice_size or rows, tokens, dtype)
+            if budget is None or estimated <= budget:
+                return AttentionPlan(slice_size, estimated, budget)
+        return AttentionPlan(1, self.estimate(1, tokens, dtype), budget)
+
+    def plan(
+        self,
+        attention_slice: Optional[Union[str, int]],
+        batch_size: int,
+        height: int,
+        width: int,
+        dtype: torch.dtype,
+        device: Union[str, torch.device],
+    ) -> AttentionPlan:
+        tokens = (height // 8) * (width // 8)
+        if attention_slice != "auto":
+            slice_size = attention_slice or None
+            if slice_size is not None and (
+                slice_size > self.heads or self.heads % slice_size != 0
+            ):
+                raise ValueError(
+                    f"`attention_slice` has to divide {self.heads} but is {slice_size}"
+                )
+            rows = slice_size or batch_size * self.heads
+            return AttentionPlan(slice_size, self.estimate(rows, tokens, dtype), None)
+        key = (batch_size, height, width, dtype, str(device))
+        plan = self.plans.get(key)
+        if plan is None:
+            with self.lock:
+                plan = self.plans.get(key)
+                if plan is None:
+                    plan = self._auto(batch_size, height, width, dtype, device)
+                    self.plans[key] = plan
+        return plan
@@ -0,0 +1,208 @@
+import io
+import json
+import os
+import time
+from dataclasses import asdict
+from typing import Dict, Iterator, List, Set, Tuple
+
+from PIL.ImageOps import fit
+
+from peacasso.cache import FileCache
+from peacasso.datamodel import GeneratorConfig
+
+
+MANIFEST_FILE = "manifest.jsonl"
+
+
+def read_configs(path: str) -> Iterator[Tuple[int, GeneratorConfig]]:
+    """Stream (line number, config) from a JSONL file, skipping blank lines and
+    reporting the lines that are not a valid config"""
+    with open(path) as file:
+        for line_number, line in enumerate(file):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                config = GeneratorConfig(**json.loads(line))
+            except (ValueError, TypeError) as exc:
+                print(f"error: line {line_number}: invalid config: {exc}")
+                continue
+            yield line_number, config
+
+
+def batch_key(config: GeneratorConfig) -> str:
+    """Configs with the same key can share a UNet batch, only their prompts and
+    seeds differ. Image prompts and multi image configs are rendered on their
+    own, and so are configs whose images would depend on the rest of the batch:
+    the DDIM step noise of eta > 0 and the guidance norm are batch wide."""
+    data = asdict(config)
+    data.pop("prompt")
+    data.pop("seed")
+    if config.mode != "prompt" or config.num_images != 1 or config.init_image:
+        return None
+    if config.eta or config.guidance_norm_threshold is not None:
+        return None
+    return json.dumps(data, sort_keys=True, default=str)
+
+
+def read_manifest(output_dir: str) -> Set[int]:
+    """Line numbers that are already done, a torn last line is ignored"""
+    done = set()
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return done
+    with open(path) as file:
+        for line in file:
+            try:
+                done.add(json.loads(line)["line"])
+            except (ValueError, KeyError):
+                continue
+    return done
+
+
+def encode_image(pil_image, config: GeneratorConfig) -> bytes:
+    """Same post processing as the /generate endpoint, so the cache is shared"""
+    pil_image = fit(pil_image, (config.image_width, config.image_height))
+    image = io.BytesIO()
+    pil_image.save(image, format="PNG")
+    pil_image.close()
+    return image.getvalue()
+
+
+def warm_cache(
+    generator,
+    cache: FileCache,
+    limit: int = 10,
+    max_seconds: float = None,
+    idle_seconds: float = 30,
+) -> int:
+    """Render the most requested configs that were pruned from the cache again,
+    each one only once no worker sharing the cache rendered for `idle_seconds`.
+    Returns the number of rendered entries."""
+    deadline = time.time() + max_seconds if max_seconds is not None else None
+    rendered = 0
+    for data in cache.missing_configs(limit):
+        lock = cache.wait_idle(idle_seconds, deadline)
+        if lock is None:
+            break
+        config = GeneratorConfig(**data)
+        try:
+            with lock:
+                result = generator.generate(config)
+        except Exception as exc:
+            print(f"error: {data['prompt']}: {exc}")
+            continue
+        cache.set(config, encode_image(result["images"][config.image_index], config))
+        if "latents" in result:
+            cache.set_latents(config, result["latents"][config.image_index])
+        rendered += 1
+    return rendered
+
+
+class BatchRunner:
+    """Renders a stream of configs, writes each image and its manifest line as
+    soon as it is ready and skips what is in the manifest or in the cache."""
+
+    def __init__(
+        self,
+        generator,
+        output_dir: str,
+        cache: FileCache,
+        batch_size: int = 4,
+        max_pending: int = 64,
+    ):
+        self.generator = generator
+        self.output_dir = output_dir
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        os.makedirs(output_dir, exist_ok=True)
+        self.done = read_manifest(output_dir)
+        self.manifest = open(os.path.join(output_dir, MANIFEST_FILE), "a")
+        self.pending: Dict[str, List[Tuple[int, GeneratorConfig]]] = {}
+        self.stats = dict(rendered=0, cached=0, skipped=0, failed=0)
+        self.start_time = time.time()
+
+    def _write(self, line_number: int, config: GeneratorConfig, content: bytes, cached: bool):
+        key = self.cache.get_key(config)
+        file_name = f"{line_number:06d}_{key}.png"
+        with open(os.path.join(self.output_dir, file_name), "wb") as file:
+            file.write(content)
+        entry = dict(line=line_number, key=key, file=file_name, cached=cached)
+        self.manifest.write(json.dumps(entry) + "\n")
+        self.manifest.flush()
+        self.done.add(line_number)
+        self.stats["cached" if cached else "rendered"] += 1
+
+    def _render(self, group: List[Tuple[int, GeneratorConfig]]):
+        configs = [config for _, config in group]
+        try:
+            if len(configs) == 1:
+                config = configs[0]
+                with self.cache.rendering():
+                    result = self.generator.generate(
+                        config, init_latents=self.cache.source_latents(config)
+                    )
+                images = [result["images"][config.image_index]]
+                latents = [
+                    result["latents"][config.image_index] if "latents" in result else None
+                ]
+            else:
+                with self.cache.rendering():
+                    result = self.generator.generate_batch(configs)
+                images = result["images"]
+                latents = result.get("latents", [None] * len(images))
+        except Exception as exc:
+            print(f"error: lines {[n for n, _ in group]}: {exc}")
+            self.stats["failed"] += len(group)
+            return
+        for (line_number, config), pil_image, image_latents in zip(group, images, latents):
+            content = encode_image(pil_image, config)
+            self.cache.set(config, content)
+            if image_latents is not None:
+                self.cache.set_latents(config, image_latents)
+            self._write(line_number, config, content, cached=False)
+
+    def _flush(self, key: str):
+        self._render(self.pending.pop(key))
+
+    def add(self, line_number: int, config: GeneratorConfig):
+        if line_number in self.done:
+            self.stats["skipped"] += 1
+            return
+        cached = self.cache.get(config)
+        if cached:
+            with cached:
+                self._write(line_number, config, cached.read(), cached=True)
+            return
+        key = batch_key(config)
+        if key is None:
+            self._render([(line_number, config)])
+            return
+        group = self.pending.setdefault(key, [])
+        group.append((line_number, config))
+        if len(group) >= self.batch_size:
+            self._flush(key)
+        elif sum(len(g) for g in self.pending.values()) > self.max_pending:
+            # bound memory on inputs with many different settings, oldest first
+            self._flush(next(iter(self.pending)))
+
+    def finish(self):
+        for key in list(self.pending):
+            self._flush(key)
+        self.manifest.close()
+
+    def images_per_minute(self) -> float:
+        elapsed = time.time() - self.start_time
+        images = self.stats["rendered"] + self.stats["cached"]
+        return images / elapsed * 60 if elapsed > 0 else 0.0
+
+    def run(self, path: str, report_every: int = 50):
+        last_report = 0
+        for line_number, config in read_configs(path):
+            self.add(line_number, config)
+            if len(self.done) - last_report >= report_every:
+                last_report = len(self.done)
+                print(f"{len(self.done)} done, {self.images_per_minute():.1f} images/min")
+        self.finish()
+        return dict(self.stats, images_per_minute=self.images_per_minute())
@@ -0,0 +1,121 @@
+"""Offline benchmarks for peacasso, see `peacasso bench --help`.
+ """
+import multiprocessing
+import platform
+import resource
+import statistics
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List
+
+import numpy as np
+
+from peacasso.version import VERSION
+
+
+def timed(fn: Callable, repeat: int = 5, warmup: int = 1) -> dict:
+    """Wall time of `fn` over `repeat` runs after `warmup` runs"""
+    for _ in range(warmup):
+        fn()
+    seconds = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start_time)
+    return dict(
+        median_s=statistics.median(seconds),
+        min_s=min(seconds),
+        max_s=max(seconds),
+        repeat=repeat,
+    )
+
+
+def percentiles(values: List[float], points: Iterable[int] = (50, 90, 99)) -> dict:
+    return dict((f"p{p}", float(np.percentile(values, p))) for p in points)
+
+
+def _measure(fn, connection):
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start_time
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    connection.send((seconds, start_rss, peak_rss))
+    connection.close()
+
+
+def peak_memory(fn: Callable) -> dict:
+    """Run `fn` in a forked process and report how much its max RSS grew.
+    max RSS only ever goes up, a fresh process per measurement keeps them apart."""
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_measure, args=(fn, sender))
+    process.start()
+    seconds, start_rss, peak_rss = receiver.recv()
+    process.join()
+    # ru_maxrss is in KiB on linux
+    return dict(
+        seconds=seconds,
+        peak_rss_mb=peak_rss / 1024,
+        rss_growth_mb=(peak_rss - start_rss) / 1024,
+    )
+
+
+def image_difference(a, b) -> dict:
+    """Mean absolute difference (0-255) and PSNR between two images"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    mse = np.mean((a - b) ** 2)
+    psnr = float("inf") if mse == 0 else 10 * np.log10(255**2 / mse)
+    return dict(mean_abs_diff=float(np.mean(np.abs(a - b))), psnr_db=float(psnr))
+
+
+def _benchmarks() -> Dict[str, Callable]:
+    # imported lazily, torch and the web backends are slow to import
+    from peacasso.benchmarks import cache, pipeline, web
+
+    return {
+        "step_time": pipeline.bench_step_time,
+        "guidance_truncation": pipeline.bench_guidance_truncation,
+        "deep_cache": pipeline.bench_deep_cache,
+        "token_merging": pipeline.bench_token_merging,
+        "tiled_vae": pipeline.bench_tiled_vae,
+        "attention_slicing": pipeline.bench_attention_slicing,
+        "draft_refine": pipeline.bench_draft_refine,
+        "cache": cache.bench_file_cache,
+        "http_generate": web.bench_http_generate,
+        "zip_stream": web.bench_zip_stream,
+        "ws_messages": web.bench_ws_messages,
+        "ws_round_trip": web.bench_ws_round_trip,
+    }
+
+
+def list_benchmarks() -> List[str]:
+    return list(_benchmarks())
+
+
+def run_benchmarks(names: Iterable[str] = None, quick: bool = False) -> dict:
+    benchmarks = _benchmarks()
+    names = list(names or benchmarks)
+    unknown = [name for name in names if name not in benchmarks]
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {unknown}, choose from {list(benchmarks)}")
+    import torch
+    import diffusers
+
+    report = dict(
+        peacasso=VERSION,
+        torch=torch.__version__,
+        diffusers=diffusers.__version__,
+        python=platform.python_version(),
+        machine=platform.machine(),
+        created_at=datetime.now().isoformat(),
+        quick=quick,
+        results={},
+    )
+    for name in names:
+        print(f"running {name}")
+        start_time = time.perf_counter()
+        report["results"][name] = benchmarks[name](quick=quick)
+        print(f"  {time.perf_counter() - start_time:.1f}s")
+    return report
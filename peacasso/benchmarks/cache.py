@@ -0,0 +1,55 @@
+import os
+import tempfile
+import time
+
+from peacasso.cache import FileCache
+from peacasso.datamodel import GeneratorConfig
+
+
+def _content(base: bytes, i: int) -> bytes:
+    """A distinct PNG sized payload per entry, so every set writes a new blob"""
+    return i.to_bytes(8, "little") + base
+
+
+def bench_file_cache(quick: bool = False) -> dict:
+    """get/set throughput of FileCache for PNG sized entries, and of storing
+    content that is already cached under another key"""
+    entries = 200 if quick else 2000
+    base = os.urandom(300 * 1024)
+    configs = [GeneratorConfig(prompt=f"prompt {i}") for i in range(entries)]
+    duplicates = [GeneratorConfig(prompt=f"duplicate {i}") for i in range(entries)]
+    with tempfile.TemporaryDirectory() as path:
+        cache = FileCache(path)
+
+        start_time = time.perf_counter()
+        for i, config in enumerate(configs):
+            cache.set(config, _content(base, i))
+        set_s = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for config in configs:
+            with cache.get(config) as file:
+                file.read()
+        hit_s = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for i in range(entries):
+            cache.get(GeneratorConfig(prompt=f"missing {i}"))
+        miss_s = time.perf_counter() - start_time
+
+        # same images under new keys, only a hard link per entry
+        start_time = time.perf_counter()
+        for i, config in enumerate(duplicates):
+            cache.set(config, _content(base, i))
+        dedup_set_s = time.perf_counter() - start_time
+        dedup = cache.dedup_stats()
+
+    return dict(
+        entries=entries,
+        entry_bytes=len(base) + 8,
+        set_per_s=entries / set_s,
+        hit_per_s=entries / hit_s,
+        miss_per_s=entries / miss_s,
+        dedup_set_per_s=entries / dedup_set_s,
+        dedup_ratio=dedup["ratio"],
+    )
@@ -0,0 +1,99 @@
+# tiny randomly initialised models, the benchmarks run offline on CPU
+import zlib
+from types import SimpleNamespace
+from typing import List, Union
+
+import torch
+from transformers import CLIPFeatureExtractor, CLIPTextConfig, CLIPTextModel
+
+from diffusers.models import AutoencoderKL, UNet2DConditionModel
+from diffusers.schedulers import PNDMScheduler
+
+from peacasso.pipelines import StableDiffusionPipeline
+
+
+class HashTokenizer:
+    """Stands in for CLIPTokenizer without downloading a vocabulary, words are
+    hashed into the vocabulary of the tiny text encoder"""
+
+    def __init__(self, vocab_size: int = 1000, model_max_length: int = 77):
+        self.vocab_size = vocab_size
+        self.model_max_length = model_max_length
+
+    def _encode(self, text: str, max_length: int) -> List[int]:
+        ids = [0] + [
+            3 + zlib.crc32(word.encode()) % (self.vocab_size - 3)
+            for word in text.lower().split()
+        ]
+        ids = ids[: max_length - 1] + [2]
+        return ids + [1] * (max_length - len(ids))
+
+    def __call__(
+        self,
+        text: Union[str, List[str]],
+        padding: str = "max_length",
+        max_length: int = None,
+        truncation: bool = True,
+        return_tensors: str = "pt",
+    ):
+        texts = [text] if isinstance(text, str) else text
+        max_length = max_length or self.model_max_length
+        input_ids = torch.tensor([self._encode(t, max_length) for t in texts])
+        return SimpleNamespace(input_ids=input_ids)
+
+
+class NoSafetyChecker:
+    """The pipeline does not run the safety checker"""
+
+
+def tiny_pipeline(seed: int = 0) -> StableDiffusionPipeline:
+    """A StableDiffusionPipeline with the SD architecture at a fraction of the width.
+    Attention runs at the full latent resolution as in SD, the VAE downsamples by 8."""
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        layers_per_block=1,
+        block_out_channels=(32, 64),
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=4,
+    )
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        block_out_channels=(32, 32, 32, 32),
+        layers_per_block=1,
+        latent_channels=4,
+    )
+    text_encoder = CLIPTextModel(
+        CLIPTextConfig(
+            bos_token_id=0,
+            eos_token_id=2,
+            pad_token_id=1,
+            hidden_size=32,
+            intermediate_size=37,
+            num_attention_heads=4,
+            num_hidden_layers=2,
+            vocab_size=1000,
+        )
+    )
+    scheduler = PNDMScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        skip_prk_steps=True,
+    )
+    return StableDiffusionPipeline(
+        vae=vae.eval(),
+        text_encoder=text_encoder.eval(),
+        tokenizer=HashTokenizer(),
+        unet=unet.eval(),
+        scheduler=scheduler,
+        feature_extractor=CLIPFeatureExtractor(),
+        safety_checker=NoSafetyChecker(),
+    )
@@ -0,0 +1,260 @@
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from peacasso import vae as vae_utils
+from peacasso.attention import AttentionPlanner
+from peacasso.benchmarks import image_difference, peak_memory, timed
+from peacasso.benchmarks.models import tiny_pipeline
+from peacasso.datamodel import GeneratorConfig
+from peacasso.generator import draft_config
+from peacasso.pipelines import decode_image
+from peacasso.schedulers import SCHEDULERS
+
+
+PROMPTS = (
+    "a sea lion wandering the streets of post apocalyptic london",
+    "a watercolor painting of a lighthouse at dawn",
+)
+SEED = 42
+MEMORY_ENV = "PEACASSO_ATTENTION_MEMORY_MB"
+
+
+def _run(pipe, prompt=PROMPTS[0], **kwargs):
+    kwargs.setdefault("height", 128)
+    kwargs.setdefault("width", 128)
+    kwargs.setdefault("num_inference_steps", 10)
+    kwargs.setdefault("attention_slice", None)
+    return pipe(prompt, seed=SEED, **kwargs)
+
+
+def _compare(pipe, baseline: dict, variants: dict, repeat: int) -> dict:
+    """Time the baseline and each variant on every prompt, report the speedup and
+    the image difference to the baseline"""
+    results = {}
+    for name, kwargs in dict(baseline=baseline, **variants).items():
+        seconds, differences = [], []
+        for prompt in PROMPTS:
+            seconds.append(timed(lambda: _run(pipe, prompt, **kwargs), repeat)["median_s"])
+            if name != "baseline":
+                reference = _run(pipe, prompt, **baseline)["images"][0]
+                image = _run(pipe, prompt, **kwargs)["images"][0]
+                differences.append(image_difference(reference, image))
+        results[name] = dict(median_s=sum(seconds) / len(seconds))
+        if differences:
+            results[name]["mean_abs_diff"] = sum(d["mean_abs_diff"] for d in differences) / len(differences)
+            results[name]["psnr_db"] = min(d["psnr_db"] for d in differences)
+    for name in variants:
+        results[name]["speedup"] = results["baseline"]["median_s"] / results[name]["median_s"]
+    return results
+
+
+def bench_step_time(quick: bool = False) -> dict:
+    """Seconds per denoising step for every scheduler"""
+    pipe = tiny_pipeline()
+    steps = 5 if quick else 20
+    results = {}
+    for scheduler in (None,) + SCHEDULERS:
+        timing = timed(
+            lambda: _run(pipe, num_inference_steps=steps, scheduler=scheduler),
+            repeat=2 if quick else 5,
+        )
+        results[scheduler or "default"] = dict(
+            timing, step_s=timing["median_s"] / steps
+        )
+    return results
+
+
+def _init_image(size: int = 128):
+    """A fixed noise image for img2img, and a mask that repaints its left half"""
+    pixels = np.random.RandomState(SEED).randint(0, 256, (size, size, 3), dtype=np.uint8)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    mask[:, : size // 2] = 255
+    return Image.fromarray(pixels), Image.fromarray(mask)
+
+
+def bench_guidance_truncation(quick: bool = False) -> dict:
+    """Speedup and image difference of guidance truncation for text2img, img2img
+    and masked inpainting"""
+    pipe = tiny_pipeline()
+    init_image, mask_image = _init_image()
+    modes = dict(
+        text2img={},
+        img2img=dict(mode="image", init_image=init_image, strength=0.8),
+        inpaint=dict(
+            mode="image", init_image=init_image, mask_image=mask_image, strength=0.8
+        ),
+    )
+    results = {}
+    for name, baseline in modes.items():
+        variants = {
+            f"cutoff_{cutoff}": dict(baseline, guidance_cutoff=cutoff)
+            for cutoff in (0.8, 0.5)
+        }
+        variants["norm_0.1"] = dict(baseline, guidance_norm_threshold=0.1)
+        results[name] = _compare(pipe, baseline, variants, repeat=1 if quick else 3)
+    return results
+
+
+def bench_deep_cache(quick: bool = False) -> dict:
+    """Speedup and image difference of each cache interval against the step
+    count, fewer steps leave fewer steps to reuse the deep features on"""
+    pipe = tiny_pipeline()
+    results = {}
+    for steps in (10, 25) if quick else (10, 25, 50):
+        baseline = dict(num_inference_steps=steps)
+        variants = {
+            f"interval_{k}": dict(baseline, deep_cache_interval=k) for k in (2, 3, 5)
+        }
+        results[f"steps_{steps}"] = _compare(
+            pipe, baseline, variants, repeat=1 if quick else 3
+        )
+    return results
+
+
+def bench_token_merging(quick: bool = False) -> dict:
+    """Time against resolution with and without token merging, and with token
+    merging on top of attention slicing"""
+    pipe = tiny_pipeline()
+    results = {}
+    for size in (128, 256) if quick else (128, 256, 384, 512):
+        baseline = dict(height=size, width=size, num_inference_steps=4)
+        variants = {
+            f"ratio_{ratio}": dict(baseline, token_merging_ratio=ratio)
+            for ratio in (0.3, 0.5)
+        }
+        variants["sliced"] = dict(baseline, attention_slice=1)
+        variants["sliced_ratio_0.5"] = dict(variants["sliced"], token_merging_ratio=0.5)
+        results[str(size)] = _compare(pipe, baseline, variants, repeat=1)
+    return results
+
+
+def bench_tiled_vae(quick: bool = False) -> dict:
+    """Peak memory of a VAE decode and encode against resolution, full and
+    tiled, and of decoding a batch at once and one image at a time"""
+    pipe = tiny_pipeline()
+    results = {}
+    for size in (256, 512, 768) if quick else (256, 512, 768, 1024, 1536):
+        latents = torch.randn(1, 4, size // 8, size // 8)
+        image = torch.rand(1, 3, size, size) * 2 - 1
+
+        def full():
+            with torch.no_grad():
+                pipe.vae.decode(latents).sample
+
+        def tiled():
+            with torch.no_grad():
+                vae_utils.tiled_decode(pipe.vae, latents)
+
+        def full_encode():
+            with torch.no_grad():
+                pipe.vae.encode(image).latent_dist.sample()
+
+        def tiled_encode():
+            with torch.no_grad():
+                vae_utils.tiled_encode(pipe.vae, image)
+
+        results[str(size)] = dict(
+            full=peak_memory(full),
+            tiled=peak_memory(tiled),
+            full_encode=peak_memory(full_encode),
+            tiled_encode=peak_memory(tiled_encode),
+        )
+
+    batch = torch.randn(4, 4, 32, 32)
+
+    def batch_decode():
+        with torch.no_grad():
+            pipe.vae.decode(batch).sample
+
+    def per_image_decode():
+        with torch.no_grad():
+            decode_image(batch, pipe.vae)
+
+    results["batch_4x256"] = dict(
+        full=peak_memory(batch_decode), per_image=peak_memory(per_image_decode)
+    )
+    return results
+
+
+def _slicing_run(pipe, prompt, size: int, attention_slice) -> dict:
+    run = lambda: _run(
+        pipe,
+        prompt,
+        height=size,
+        width=size,
+        num_inference_steps=2,
+        attention_slice=attention_slice,
+    )
+    measurement = peak_memory(run)
+    measurement["images_per_s"] = len(prompt) / measurement["seconds"]
+    measurement["plan"] = run()["attention_plan"]
+    return measurement
+
+
+def bench_attention_slicing(quick: bool = False) -> dict:
+    """Throughput against peak memory for each slice size and for the planner,
+    against the batch size, with the free memory and with a budget the
+    unsliced attention does not fit in, and the cost of a cached plan"""
+    pipe = tiny_pipeline()
+    heads = pipe.unet.config.attention_head_dim
+    size = 256 if quick else 512
+    results = {}
+    for batch_size in (1, 2) if quick else (1, 2, 4):
+        prompt = [PROMPTS[0]] * batch_size
+        batch = {}
+        for attention_slice in (None, heads // 2, 1, "auto"):
+            batch[str(attention_slice)] = _slicing_run(pipe, prompt, size, attention_slice)
+        # the planner takes ATTENTION_MEMORY_FRACTION of the memory, the
+        # budget is half of the unsliced scores of the guided batch
+        full = pipe.attention_planner.estimate(
+            2 * batch_size * heads, (size // 8) ** 2, pipe.unet.dtype
+        )
+        planner, memory = pipe.attention_planner, os.environ.get(MEMORY_ENV)
+        pipe.attention_planner = AttentionPlanner(pipe.unet)
+        os.environ[MEMORY_ENV] = str(full // 2**20)
+        try:
+            batch["auto_budget"] = _slicing_run(pipe, prompt, size, "auto")
+        finally:
+            pipe.attention_planner = planner
+            if memory is None:
+                del os.environ[MEMORY_ENV]
+            else:
+                os.environ[MEMORY_ENV] = memory
+        results[f"batch_{batch_size}"] = batch
+
+    dtype, device = pipe.unet.dtype, pipe.device
+    plan = lambda: pipe.attention_planner.plan("auto", 2, size, size, dtype, device)
+    results["plan_lookup_us"] = timed(plan, repeat=1000)["median_s"] * 1e6
+    return results
+
+
+def bench_draft_refine(quick: bool = False) -> dict:
+    """Latency of a draft, and of a draft plus its refine, against a direct
+    full render"""
+    pipe = tiny_pipeline()
+    size = 256 if quick else 512
+    steps = 10 if quick else 20
+    repeat = 1 if quick else 3
+    direct = dict(height=size, width=size, num_inference_steps=steps)
+    draft = draft_config(GeneratorConfig(prompt=PROMPTS[0], mode="draft", **direct))
+    draft = dict(
+        height=draft.height, width=draft.width, num_inference_steps=draft.num_inference_steps
+    )
+    latents = _run(pipe, **draft)["latents"]
+    refine = dict(direct, mode="refine", init_latents=latents, strength=0.5)
+
+    direct_s = timed(lambda: _run(pipe, **direct), repeat)["median_s"]
+    draft_s = timed(lambda: _run(pipe, **draft), repeat)["median_s"]
+    refine_s = timed(lambda: _run(pipe, **refine), repeat)["median_s"]
+    return dict(
+        direct_s=direct_s,
+        draft_s=draft_s,
+        refine_s=refine_s,
+        total_s=draft_s + refine_s,
+        draft_speedup=direct_s / draft_s,
+        total_speedup=direct_s / (draft_s + refine_s),
+        draft=draft,
+    )
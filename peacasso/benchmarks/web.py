@@ -0,0 +1,273 @@
+import asyncio
+import base64
+import http.client
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from peacasso.benchmarks import peak_memory, percentiles
+from peacasso.utils import stream_zip
+
+
+@contextmanager
+def _fake_generator():
+    """The backends load their generator at import, without HF_API_TOKEN it is
+    the FakeImageGenerator. The cache is pointed at a temporary directory."""
+    from peacasso.cache import cache
+
+    token = os.environ.pop("HF_API_TOKEN", None)
+    path = cache.path
+    try:
+        with tempfile.TemporaryDirectory() as cache_path:
+            cache.path = cache_path
+            yield
+    finally:
+        cache.path = path
+        if token is not None:
+            os.environ["HF_API_TOKEN"] = token
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _png(size: int = 512) -> bytes:
+    """A noisy image, close to the worst case for PNG size"""
+    pixels = np.random.RandomState(0).randint(0, 256, (size, size, 3), dtype=np.uint8)
+    image = io.BytesIO()
+    Image.fromarray(pixels).save(image, format="PNG")
+    return image.getvalue()
+
+
+def bench_http_generate(quick: bool = False) -> dict:
+    """/api/generate latency of the multi host backend with FakeImageGenerator"""
+    import uvicorn
+
+    requests = 10 if quick else 50
+    with _fake_generator():
+        from peacasso.web.backend.appmh import app
+
+        port = _free_port()
+        server = uvicorn.Server(
+            uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+        )
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.01)
+
+        def post(prompt):
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            body = json.dumps(dict(prompt=prompt, width=512, height=512))
+            start_time = time.perf_counter()
+            connection.request(
+                "POST", "/api/generate", body, {"Content-Type": "application/json"}
+            )
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            return time.perf_counter() - start_time
+
+        try:
+            misses = [post(f"bench prompt {i} {uuid.uuid4()}") for i in range(requests)]
+            post("bench cached prompt")
+            hits = [post("bench cached prompt") for _ in range(requests)]
+        finally:
+            server.should_exit = True
+            thread.join()
+    return dict(
+        requests=requests,
+        miss_s=percentiles(misses),
+        hit_s=percentiles(hits),
+    )
+
+
+def _png_bytes(image) -> bytes:
+    data = io.BytesIO()
+    image.save(data, format="PNG")
+    image.close()
+    return data.getvalue()
+
+
+def _first_byte(chunks) -> dict:
+    """Time to the first and to the last chunk of a response body"""
+    start_time = time.perf_counter()
+    iterator = iter(chunks())
+    next(iterator)
+    ttfb_s = time.perf_counter() - start_time
+    for _ in iterator:
+        pass
+    return dict(ttfb_s=ttfb_s, total_s=time.perf_counter() - start_time)
+
+
+def bench_zip_stream(quick: bool = False) -> dict:
+    """Time to first byte and peak memory of the classic /generate zip, built in
+    memory against streamed, for 1 to 8 images"""
+    from peacasso.benchmarks.models import tiny_pipeline
+    from peacasso.benchmarks.pipeline import PROMPTS, _run
+
+    pipe = tiny_pipeline()
+    size = 256 if quick else 512
+    results = {}
+    for num_images in (1, 4, 8) if quick else range(1, 9):
+        kwargs = dict(height=size, width=size, num_inference_steps=2)
+        prompt = [PROMPTS[0]] * num_images
+
+        def buffered():
+            images = _run(pipe, prompt, **kwargs)["images"]
+            zip_io = io.BytesIO()
+            with zipfile.ZipFile(zip_io, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+                for i, image in enumerate(images):
+                    archive.writestr(f"{i}.png", _png_bytes(image))
+            return iter([zip_io.getvalue()])
+
+        def streamed():
+            latents = _run(pipe, prompt, output_type="latent", **kwargs)["latents"]
+            return stream_zip(
+                (f"{i}.png", _png_bytes(image))
+                for i, image in enumerate(pipe.iter_images(latents))
+            )
+
+        results[str(num_images)] = dict(
+            (name, dict(_first_byte(chunks), **peak_memory(lambda: _first_byte(chunks))))
+            for name, chunks in (("buffered", buffered), ("streamed", streamed))
+        )
+    return results
+
+
+def bench_ws_messages(quick: bool = False) -> dict:
+    """Bytes on the wire and CPU time per result message, base64 JSON against
+    binary, to build it on the worker and to read the image back out of it on
+    the dispatcher"""
+    # the worker loads its generator at import, the first import decides
+    # which one ws_round_trip gets as well
+    with _fake_generator():
+        from peacasso.ws.backend.appmhws import (
+            PROTOCOL_BINARY,
+            PROTOCOL_JSON,
+            result_message,
+            unpack_binary_message,
+        )
+
+    image = _png()
+    repeat = 20 if quick else 200
+    pk = uuid.uuid4()
+    results = dict(image_bytes=len(image))
+    decoders = {
+        PROTOCOL_JSON: lambda message: base64.b64decode(json.loads(message)["data"]["image"]),
+        PROTOCOL_BINARY: lambda message: unpack_binary_message(message)[1],
+    }
+    for protocol, decode in decoders.items():
+        start_time = time.process_time()
+        for _ in range(repeat):
+            message = result_message(pk, image, protocol)
+        cpu_s = (time.process_time() - start_time) / repeat
+        assert decode(message) == image
+        start_time = time.process_time()
+        for _ in range(repeat):
+            decode(message)
+        decode_cpu_s = (time.process_time() - start_time) / repeat
+        results[protocol] = dict(
+            message_bytes=len(message),
+            cpu_ms=cpu_s * 1000,
+            decode_cpu_ms=decode_cpu_s * 1000,
+        )
+    results["bytes_saved"] = (
+        results[PROTOCOL_JSON]["message_bytes"] - results[PROTOCOL_BINARY]["message_bytes"]
+    )
+    return results
+
+
+async def _round_trip(jobs: int, binary: bool) -> dict:
+    """A stand-in dispatcher hands `jobs` jobs to one worker over the pull protocol"""
+    import websockets
+
+    from peacasso.ws.backend import appmhws
+
+    sent, received, sizes = {}, {}, []
+    pending = [str(uuid.uuid4()) for _ in range(jobs)]
+    done = asyncio.Event()
+
+    def job(pk):
+        return dict(
+            errors=[],
+            action="create",
+            response_status=200,
+            data=dict(
+                id=pk,
+                prompt_uuid=str(uuid.uuid4()),
+                prompt_config=dict(prompt=f"round trip {pk}"),
+                created_at=datetime.now().isoformat(),
+                website="bench",
+            ),
+        )
+
+    async def dispatcher(websocket, path=None):
+        async for message in websocket:
+            if isinstance(message, bytes):
+                header, _ = appmhws.unpack_binary_message(message)
+            else:
+                header = json.loads(message)
+            if header["action"] == "login":
+                protocol = appmhws.PROTOCOL_BINARY if header.get("protocols") else None
+                await websocket.send(json.dumps(dict(
+                    errors=[],
+                    action="login",
+                    response_status=200,
+                    data=dict(message="ok", protocol=protocol, pull=True),
+                )))
+            elif header["action"] == "pull":
+                for _ in range(header["data"]["free_slots"]):
+                    if not pending:
+                        break
+                    pk = pending.pop()
+                    sent[pk] = time.perf_counter()
+                    await websocket.send(json.dumps(job(pk)))
+            elif header["action"] == "update":
+                received[header["pk"]] = time.perf_counter()
+                sizes.append(len(message))
+                if len(received) == jobs:
+                    done.set()
+
+    port = _free_port()
+    async with websockets.serve(dispatcher, "127.0.0.1", port):
+        start_time = time.perf_counter()
+        worker = asyncio.create_task(
+            appmhws.main("ws", "127.0.0.1", port, "/", token="bench", binary=binary)
+        )
+        try:
+            await asyncio.wait_for(done.wait(), timeout=60 + jobs * 5)
+        finally:
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+        total_s = time.perf_counter() - start_time
+    latencies = [received[pk] - sent[pk] for pk in received]
+    return dict(
+        jobs=jobs,
+        jobs_per_s=jobs / total_s,
+        latency_s=percentiles(latencies),
+        message_bytes=sum(sizes) / len(sizes),
+    )
+
+
+def bench_ws_round_trip(quick: bool = False) -> dict:
+    """Dispatcher to worker to dispatcher latency with FakeImageGenerator"""
+    jobs = 5 if quick else 20
+    with _fake_generator():
+        return dict(
+            json=asyncio.run(_round_trip(jobs, binary=False)),
+            binary=asyncio.run(_round_trip(jobs, binary=True)),
+        )
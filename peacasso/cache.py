@@ -1,11 +1,24 @@
+import hashlib
+import json
 import os
+import sqlite3
+import threading
+import time
 import uuid
-from dataclasses import field, asdict
+from contextlib import contextmanager
+from dataclasses import field, fields, asdict
 from random import seed
 from typing import Any, List, Optional, Union
 from pydantic.dataclasses import dataclass
 from functools import wraps
 
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # windows, warming is not held back by busy workers
+    fcntl = None
+
 
 CACHE_KEY_FIELDS = (
     "prompt",
@@ -16,6 +29,17 @@ CACHE_KEY_FIELDS = (
     "strength",
 )
 
+# fields added after the cache was populated, they are only part of the key
+# when they differ from their default so existing cache entries keep their keys
+OPTIONAL_CACHE_KEY_FIELDS = (
+    "scheduler",
+    "guidance_cutoff",
+    "guidance_norm_threshold",
+    "deep_cache_interval",
+    "token_merging_ratio",
+    "source_key",
+)
+
 
 @dataclass
 class CacheConfig:
@@ -23,7 +47,7 @@ class CacheConfig:
 
     prompt: str
     num_images: int = 1
-    mode: str = "prompt"   # prompt, image, mask
+    mode: str = "prompt"   # prompt, image, mask, variation, draft, refine
     height: Optional[int] = 512
     width: Optional[int] = 512
     num_inference_steps: Optional[int] = 50
@@ -37,44 +61,456 @@ class CacheConfig:
     attention_slice: Optional[Union[str, int]] = None
     image_width: Optional[int] = 512
     image_height: Optional[int] = 512
+    scheduler: Optional[str] = None
+    guidance_cutoff: Optional[float] = None
+    guidance_norm_threshold: Optional[float] = None
+    deep_cache_interval: Optional[int] = None
+    token_merging_ratio: Optional[float] = None
+    source_key: Optional[str] = None
+    draft_scale: float = 0.5
+    draft_steps: int = 8
 
     def get_cache_key(self):
         return str(uuid.uuid5(uuid.NAMESPACE_OID, str(self.preset_dict())))
 
     def preset_dict(self):
         data = asdict(self)
-        return dict((k, data[k]) for k in CACHE_KEY_FIELDS)
+        defaults = dict((f.name, f.default) for f in fields(self))
+        preset = dict((k, data[k]) for k in CACHE_KEY_FIELDS)
+        for k in OPTIONAL_CACHE_KEY_FIELDS:
+            if data[k] != defaults[k]:
+                preset[k] = data[k]
+        # keys from before these modes leave out mode and size. A draft must not
+        # share its key with the full render of the config, and a variation or
+        # refine of a source with a refine or another size of it. Another seed
+        # is another variation.
+        if self.mode == "draft":
+            for k in ("mode", "height", "width", "draft_scale", "draft_steps"):
+                preset[k] = data[k]
+        elif self.source_key is not None:
+            for k in ("mode", "height", "width", "seed"):
+                preset[k] = data[k]
+        return preset
+
+
+def is_cache_key(key) -> bool:
+    """Keys are uuid5 strings, anything else, e.g. a path from a client, is not"""
+    try:
+        return str(uuid.UUID(key)) == key
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
+INDEX_FILE = "index.sqlite"
+BLOBS_DIR = "blobs"
+LATENTS_SUFFIX = ".latents"
+RENDER_LOCK_FILE = "render.lock"
+# 4x256x256 fp16, the latents of a 2048px image
+MAX_LATENT_BYTES = 512 * 1024
+
+
+class CacheIndex:
+    """
+    SQLite index of the cache entries: size, creation and last hit time, hit
+    count and the config that rendered the entry. Pruned entries keep their row
+    with present = 0, so their hit counts can be used to warm the cache.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            # WAL keeps the web and ws workers from blocking each other
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_hit REAL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    present INTEGER NOT NULL DEFAULT 1,
+                    config TEXT
+                )"""
+            )
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(entries)")]
+            if "digest" not in columns:
+                self.connection.execute("ALTER TABLE entries ADD COLUMN digest TEXT")
+
+    def execute(self, sql: str, parameters=()) -> list:
+        with self.lock, self.connection:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def add(
+        self,
+        key: str,
+        size: int,
+        config: str = None,
+        created: float = None,
+        digest: str = None,
+    ):
+        self.execute(
+            """INSERT INTO entries (key, size, created, config, digest)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET size = excluded.size, present = 1,
+            config = COALESCE(excluded.config, config),
+            digest = COALESCE(excluded.digest, digest)""",
+            (key, size, created or time.time(), config, digest),
+        )
+
+    def hit(self, key: str):
+        self.execute(
+            "UPDATE entries SET hits = hits + 1, last_hit = ? WHERE key = ?",
+            (time.time(), key),
+        )
+
+    def removed(self, key: str):
+        self.execute("UPDATE entries SET present = 0, size = 0 WHERE key = ?", (key,))
+
+    def close(self):
+        self.connection.close()
 
 
 class FileCache:
+    """
+    Images are stored once per content in a content addressed blob store,
+    blobs/<digest[:2]>/<digest>. The file of a key, <key[:8]>/<key>, is a hard
+    link to its blob, so configs that render byte identical images share the
+    disk space. A blob without links is garbage, see collect_garbage.
+    The final latents of an image are kept next to its file, <key>.latents,
+    so a variation can start from them without decoding and encoding the PNG.
+    """
+
     def __init__(self, path: str = os.environ.get("PEACASSO_CACHE_DIR")):
         self.path = path or "cache"
+        self._index = None
+        self._index_lock = threading.Lock()
+
+    @property
+    def index(self) -> CacheIndex:
+        # opened on first use, the path may still be changed after __init__
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with self._index_lock:
+            if self._index is None or self._index.path != index_path:
+                os.makedirs(self.path, exist_ok=True)
+                self._index = CacheIndex(index_path)
+            return self._index
+
+    def _open_render_lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        return open(os.path.join(self.path, RENDER_LOCK_FILE), "a")
+
+    @contextmanager
+    def rendering(self):
+        """Held shared by the workers while they render. Its mtime is the end of
+        the last render, see wait_idle."""
+        with self._open_render_lock() as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                os.utime(file.name)
+
+    def wait_idle(self, idle_seconds: float, deadline: float = None, poll: float = 0.5):
+        """Take the render lock exclusively once no worker rendered for
+        `idle_seconds`. Returns the locked file, closing it releases the lock,
+        or None when `deadline` passed first. Workers that start rendering in
+        the meantime wait for the one render the lock is held for."""
+        file = self._open_render_lock()
+        while deadline is None or time.time() < deadline:
+            if fcntl is None:
+                return file
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pass
+            else:
+                if time.time() - os.fstat(file.fileno()).st_mtime >= idle_seconds:
+                    return file
+                fcntl.flock(file, fcntl.LOCK_UN)
+            time.sleep(poll)
+        file.close()
+        return None
 
     def _get_path_from_key(self, key: str):
         return os.path.join(self.path, key[:8])
 
+    def get_file(self, key: str) -> str:
+        return os.path.join(self._get_path_from_key(key), key)
+
+    def get_blob(self, digest: str) -> str:
+        return os.path.join(self.path, BLOBS_DIR, digest[:2], digest)
+
+    def _store_blob(self, content: bytes) -> str:
+        digest = hashlib.sha256(content).hexdigest()
+        blob = self.get_blob(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            # write and rename, a reader never sees a partial blob
+            temp_file = f"{blob}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_file, "wb") as file:
+                file.write(content)
+            os.replace(temp_file, blob)
+        return digest
+
+    def _link(self, digest: str, cache_file: str, content: bytes):
+        """Point `cache_file` at the blob, a copy where hard links fail"""
+        temp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.link(self.get_blob(digest), temp_file)
+        except OSError:
+            with open(temp_file, "wb") as file:
+                file.write(content)
+        os.replace(temp_file, cache_file)
+
+    def size(self) -> int:
+        """Number of cached images"""
+        return self.index.execute("SELECT COUNT(*) FROM entries WHERE present = 1")[0][0]
+
+    def rebuild_index(self) -> int:
+        """Add the files that are not in the index yet, e.g. from before the
+        index existed. Returns the number of added entries."""
+        known = set(key for key, in self.index.execute("SELECT key FROM entries WHERE present = 1"))
+        added = 0
+        for root, dirs, files in os.walk(self.path):
+            if root == self.path:
+                dirs[:] = [d for d in dirs if d != BLOBS_DIR]
+                continue
+            for key in files:
+                # latents and temporary files have a suffix, keys do not
+                if "." not in key and key not in known:
+                    stat = os.stat(os.path.join(root, key))
+                    self.index.add(key, stat.st_size, created=stat.st_mtime)
+                    added += 1
+        return added
+
+    def stats(self, top: int = 10, stale_days: float = 30) -> dict:
+        """Size of the cache, the most hit entries and the entries not hit
+        within `stale_days`"""
+        stale_before = time.time() - stale_days * 86400
+        entries, size, hits = self.index.execute(
+            """SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0)
+            FROM entries WHERE present = 1"""
+        )[0]
+        stale, stale_size = self.index.execute(
+            """SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries
+            WHERE present = 1 AND COALESCE(last_hit, created) < ?""",
+            (stale_before,),
+        )[0]
+        hot = self.index.execute(
+            """SELECT key, hits, last_hit, present, config FROM entries
+            WHERE hits > 0 ORDER BY hits DESC LIMIT ?""",
+            (top,),
+        )
+        return dict(
+            self.dedup_stats(),
+            entries=entries,
+            size=size,
+            hits=hits,
+            stale_entries=stale,
+            stale_size=stale_size,
+            hot=[
+                dict(
+                    key=key,
+                    hits=hits,
+                    last_hit=last_hit,
+                    present=bool(present),
+                    prompt=json.loads(config)["prompt"] if config else None,
+                )
+                for key, hits, last_hit, present, config in hot
+            ],
+        )
+
+    def prune(self, max_size: int = None, older_than_days: float = None) -> dict:
+        """Remove entries not hit within `older_than_days`, then the least
+        recently used entries until the stored blobs take at most `max_size`
+        bytes. A blob shared by several keys is freed with its last key."""
+        removed, freed = 0, 0
+        if older_than_days is not None:
+            stale_before = time.time() - older_than_days * 86400
+            for key, in self.index.execute(
+                """SELECT key FROM entries
+                WHERE present = 1 AND COALESCE(last_hit, created) < ?""",
+                (stale_before,),
+            ):
+                removed, freed = removed + 1, freed + self.remove(key)
+        if max_size is not None:
+            total = self.dedup_stats()["stored_size"]
+            for key, in self.index.execute(
+                """SELECT key FROM entries WHERE present = 1
+                ORDER BY COALESCE(last_hit, created)"""
+            ):
+                if total <= max_size:
+                    break
+                key_freed = self.remove(key)
+                total -= key_freed
+                removed, freed = removed + 1, freed + key_freed
+        return dict(removed=removed, freed=freed)
+
+    def missing_configs(self, limit: int = 10) -> list:
+        """Configs of the most hit entries that are no longer on disk"""
+        return [
+            json.loads(config)
+            for config, in self.index.execute(
+                """SELECT config FROM entries
+                WHERE present = 0 AND config IS NOT NULL AND hits > 0
+                ORDER BY hits DESC LIMIT ?""",
+                (limit,),
+            )
+        ]
+
+    def remove(self, key: str) -> int:
+        """Remove an entry, returns the image bytes freed on disk. That is 0
+        while other keys still link to its blob."""
+        cache_file = self.get_file(key)
+        digests = self.index.execute("SELECT digest FROM entries WHERE key = ?", (key,))
+        digest = digests[0][0] if digests else None
+        freed = 0
+        if digest is None and os.path.exists(cache_file):
+            # cached before the blob store, the file is the only copy
+            freed = os.stat(cache_file).st_size
+        for path in (cache_file, cache_file + LATENTS_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        self.index.removed(key)
+        if digest:
+            freed += self._remove_blob_if_unreferenced(digest)
+        return freed
+
+    def _remove_blob_if_unreferenced(self, digest: str) -> int:
+        """Delete a blob that no key links to, returns the freed bytes"""
+        blob = self.get_blob(digest)
+        try:
+            stat = os.stat(blob)
+        except FileNotFoundError:
+            return 0
+        if stat.st_nlink > 1:
+            return 0
+        os.remove(blob)
+        return stat.st_size
+
+    def dedup_stats(self) -> dict:
+        """Bytes the keys refer to against bytes stored"""
+        logical = self.index.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries WHERE present = 1"
+        )[0][0]
+        stored = self.index.execute(
+            """SELECT COALESCE(SUM(size), 0) FROM (
+                SELECT MAX(size) AS size FROM entries
+                WHERE present = 1 AND digest IS NOT NULL GROUP BY digest
+                UNION ALL
+                SELECT size FROM entries WHERE present = 1 AND digest IS NULL
+            )"""
+        )[0][0]
+        return dict(
+            logical_size=logical,
+            stored_size=stored,
+            saved=logical - stored,
+            ratio=logical / stored if stored else 1.0,
+        )
+
+    def collect_garbage(self) -> dict:
+        """Move files cached before the blob store into it and delete the blobs
+        no key links to"""
+        migrated, freed = 0, 0
+        for key, in self.index.execute(
+            "SELECT key FROM entries WHERE present = 1 AND digest IS NULL"
+        ):
+            cache_file = self.get_file(key)
+            if not os.path.exists(cache_file):
+                self.index.removed(key)
+                continue
+            with open(cache_file, "rb") as file:
+                content = file.read()
+            digest = self._store_blob(content)
+            self._link(digest, cache_file, content)
+            self.index.execute("UPDATE entries SET digest = ? WHERE key = ?", (digest, key))
+            migrated += 1
+        blobs_path = os.path.join(self.path, BLOBS_DIR)
+        for root, _, files in os.walk(blobs_path):
+            for name in files:
+                if not name.endswith(".tmp"):
+                    freed += self._remove_blob_if_unreferenced(name)
+        return dict(migrated=migrated, freed=freed)
+
+    def _get_config(self, prompt_config) -> Optional[str]:
+        """JSON of a text prompt config so the entry can be rendered again"""
+        if prompt_config.mode != "prompt" or prompt_config.init_image:
+            return None
+        data = asdict(prompt_config)
+        # the generator repeats the prompt num_images times
+        if isinstance(data["prompt"], (list, tuple)):
+            data["prompt"] = data["prompt"][0]
+        data.pop("init_image", None)
+        data.pop("mask_image", None)
+        return json.dumps(data, default=str)
+
     def _get_data(self, prompt_config):
         data = asdict(prompt_config)
         if isinstance(data["prompt"], (list, tuple)):
             data["prompt"] = " ".join(data["prompt"])
         return data
     
+    def get_key(self, prompt_config) -> str:
+        return CacheConfig(**self._get_data(prompt_config)).get_cache_key()
+
     def get(self, prompt_config):
-        data = self._get_data(prompt_config)
-        key = CacheConfig(**data).get_cache_key()
-        cache_path = os.path.join(self._get_path_from_key(key), key)
+        key = self.get_key(prompt_config)
+        cache_path = self.get_file(key)
         if os.path.exists(cache_path):
+            self.index.hit(key)
             return open(cache_path, "rb")
         return None
 
     def set(self, prompt_config, content):
-        data = self._get_data(prompt_config)
-        key = CacheConfig(**data).get_cache_key()
+        key = self.get_key(prompt_config)
         cache_path = self._get_path_from_key(key)
         os.makedirs(cache_path, exist_ok=True)
         cache_file = os.path.join(cache_path, key)
-        with open(cache_file, "wb") as file:
-            file.write(content)
+        digest = self._store_blob(content)
+        self._link(digest, cache_file, content)
+        self.index.add(
+            key, len(content), self._get_config(prompt_config), digest=digest
+        )
+
+    def set_latents(self, prompt_config, latents) -> bool:
+        """Store the final latents of an image as fp16, returns False when they
+        are larger than MAX_LATENT_BYTES"""
+        latents = np.asarray(latents, dtype=np.float16)
+        if latents.nbytes > MAX_LATENT_BYTES:
+            return False
+        key = self.get_key(prompt_config)
+        os.makedirs(self._get_path_from_key(key), exist_ok=True)
+        latents_file = self.get_file(key) + LATENTS_SUFFIX
+        temp_file = f"{latents_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, "wb") as file:
+            np.save(file, latents)
+        os.replace(temp_file, latents_file)
+        return True
+
+    def source_latents(self, prompt_config) -> Optional[np.ndarray]:
+        """Latents a variation or refine config starts from, None for other modes"""
+        if prompt_config.mode not in ("variation", "refine"):
+            return None
+        if prompt_config.source_key is None:
+            raise ValueError(f"mode={prompt_config.mode} needs a source_key")
+        latents = self.get_latents(prompt_config.source_key)
+        if latents is None:
+            raise ValueError(f"No latents cached for {prompt_config.source_key}")
+        return latents
+
+    def get_latents(self, key: str) -> Optional[np.ndarray]:
+        """Latents of the cache entry `key`, None if they were not stored"""
+        if not is_cache_key(key):
+            raise ValueError(f"Invalid cache key {key!r}")
+        latents_file = self.get_file(key) + LATENTS_SUFFIX
+        if not os.path.exists(latents_file):
+            return None
+        with open(latents_file, "rb") as file:
+            return np.load(file)
 
 
 cache = FileCache()
@@ -1,9 +1,12 @@
+import os
 import typer
 import uvicorn
 
 # from peacasso.web.backend.app import launch
 
 app = typer.Typer()
+cache_app = typer.Typer(help="Inspect and maintain the image cache.")
+app.add_typer(cache_app, name="cache")
 
 
 @app.command()
@@ -22,6 +25,156 @@ def ui(
     )
 
 
+@app.command()
+def batch(
+    input: str,
+    output_dir: str = "batch_output",
+    batch_size: int = 4,
+    cache_dir: str = os.environ.get("PEACASSO_CACHE_DIR"),
+):
+    """
+    Render every GeneratorConfig line of a JSONL file into output_dir. Configs that only differ in their prompt share a UNet batch. Lines in output_dir/manifest.jsonl or in the cache are skipped, so an interrupted run can be restarted.
+    """
+    from peacasso.batch import BatchRunner
+    from peacasso.cache import FileCache
+
+    runner = BatchRunner(
+        _load_generator(), output_dir, FileCache(cache_dir), batch_size=batch_size
+    )
+    stats = runner.run(input)
+    print(
+        "{rendered} rendered, {cached} from cache, {skipped} skipped, {failed} failed, "
+        "{images_per_minute:.1f} images/min".format(**stats)
+    )
+
+
+@app.command()
+def bench(
+    only: str = None,
+    output: str = "bench.json",
+    quick: bool = False,
+):
+    """
+    Run the offline benchmark suite on tiny random models and the fake generator, results are written to output as JSON. Pass a comma separated list of benchmark names to --only to run a subset.
+    """
+    import json
+    from peacasso.benchmarks import list_benchmarks, run_benchmarks
+
+    names = only.split(",") if only else list_benchmarks()
+    report = run_benchmarks(names, quick=quick)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"results written to {output}")
+
+
+def _load_generator():
+    from peacasso.generator import FakeImageGenerator, ImageGenerator
+
+    hf_token = os.environ.get("HF_API_TOKEN")
+    if hf_token:
+        return ImageGenerator(token=hf_token)
+    return FakeImageGenerator(token=hf_token)
+
+
+@cache_app.command()
+def stats(
+    cache_dir: str = os.environ.get("PEACASSO_CACHE_DIR"),
+    top: int = 10,
+    stale_days: float = 30,
+    rebuild: bool = False,
+):
+    """
+    Show the size of the cache, the most hit entries and the stale entries. Pass --rebuild to index files cached before the index existed.
+    """
+    from peacasso.cache import FileCache
+
+    cache = FileCache(cache_dir)
+    if rebuild:
+        print(f"indexed {cache.rebuild_index()} files")
+    stats = cache.stats(top=top, stale_days=stale_days)
+    print(
+        "{entries} entries, {size_mb:.1f} MB, {hits} hits, "
+        "{stale_entries} stale ({stale_mb:.1f} MB)".format(
+            size_mb=stats["size"] / 2**20,
+            stale_mb=stats["stale_size"] / 2**20,
+            **stats,
+        )
+    )
+    print(
+        "{stored_mb:.1f} MB stored, dedup ratio {ratio:.2f}, {saved_mb:.1f} MB saved".format(
+            stored_mb=stats["stored_size"] / 2**20,
+            saved_mb=stats["saved"] / 2**20,
+            **stats,
+        )
+    )
+    for entry in stats["hot"]:
+        print(
+            "{hits:>6} {key} {state} {prompt}".format(
+                state="" if entry["present"] else "(pruned)", **entry
+            )
+        )
+
+
+@cache_app.command()
+def prune(
+    cache_dir: str = os.environ.get("PEACASSO_CACHE_DIR"),
+    max_size_mb: float = None,
+    older_than_days: float = None,
+):
+    """
+    Remove entries not hit for --older-than-days, then the least recently used entries until the cache fits in --max-size-mb.
+    """
+    from peacasso.cache import FileCache
+
+    max_size = int(max_size_mb * 2**20) if max_size_mb is not None else None
+    result = FileCache(cache_dir).prune(max_size, older_than_days)
+    print("removed {removed} entries, freed {freed_mb:.1f} MB".format(
+        freed_mb=result["freed"] / 2**20, **result
+    ))
+
+
+@cache_app.command()
+def gc(cache_dir: str = os.environ.get("PEACASSO_CACHE_DIR")):
+    """
+    Move files cached before the blob store into it and delete blobs no entry refers to.
+    """
+    from peacasso.cache import FileCache
+
+    cache = FileCache(cache_dir)
+    result = cache.collect_garbage()
+    dedup = cache.dedup_stats()
+    print(
+        "migrated {migrated} entries, freed {freed_mb:.1f} MB, dedup ratio {ratio:.2f}, "
+        "{saved_mb:.1f} MB saved".format(
+            freed_mb=result["freed"] / 2**20,
+            saved_mb=dedup["saved"] / 2**20,
+            **result,
+            **dedup,
+        )
+    )
+
+
+@cache_app.command()
+def warm(
+    cache_dir: str = os.environ.get("PEACASSO_CACHE_DIR"),
+    limit: int = 10,
+    max_seconds: float = None,
+    idle_seconds: float = 30,
+    nice: int = 10,
+):
+    """
+    Render the most requested pruned entries again while the workers are idle: each entry waits until no worker sharing the cache directory rendered for --idle-seconds. A worker that gets a job meanwhile waits for at most one warm render. --max-seconds bounds the run, --nice lowers the CPU priority.
+    """
+    from peacasso.batch import warm_cache
+    from peacasso.cache import FileCache
+
+    os.nice(nice)
+    rendered = warm_cache(
+        _load_generator(), FileCache(cache_dir), limit, max_seconds, idle_seconds
+    )
+    print(f"rendered {rendered} entries")
+
+
 @app.command()
 def list():
     print("list")
@@ -14,17 +14,30 @@ def ws(
     host: str = "meaningful.noir.studio",
     port: int = 443,
     path: str = "/ws/generate/",
-    token: str = os.environ.get("MH_BACKEND_TOKEN") 
+    token: str = os.environ.get("MH_BACKEND_TOKEN"),
+    binary: bool = True,
+    state_dir: str = os.environ.get("PEACASSO_WS_STATE_DIR"),
+    max_backoff: float = 60.0,
+    slots: int = 2,
+    pull: bool = True,
 ):
     """
     Launch the peacasso websocket client.Pass in parameters scheme, host, port and path to override the default values.
+    With --binary images are sent as raw bytes in binary frames when the server accepts it.
+    The client reconnects with backoff, pass --state-dir to keep queued jobs and unsent results on disk.
+    With --pull the client asks a balancing dispatcher for at most --slots jobs at a time.
     """
     asyncio.run(main(
         scheme=scheme,
         host=host,
         port=port,
         path=path,
-        token=token
+        token=token,
+        binary=binary,
+        state_dir=state_dir,
+        max_backoff=max_backoff,
+        slots=slots,
+        pull_work=pull,
     ))        
         
 
@@ -11,7 +11,7 @@ class GeneratorConfig:
 
     prompt: Union[str, List[str]]
     num_images: int = 1
-    mode: str = "prompt"   # prompt, image, mask
+    mode: str = "prompt"   # prompt, image, mask, variation, draft, refine
     height: Optional[int] = 512
     width: Optional[int] = 512
     num_inference_steps: Optional[int] = 20
@@ -24,7 +24,18 @@ class GeneratorConfig:
     seed: Optional[int] = None
     return_intermediates: bool = False
     mask_image: Any = None
-    attention_slice: Optional[Union[str, int]] = None
+    attention_slice: Optional[Union[str, int]] = "auto"  # auto, slice size or None
     image_index: Optional[int] = 0
     image_width: Optional[int] = 512
     image_height: Optional[int] = 512
+    scheduler: Optional[str] = None  # None (model default), ddim, pndm, lms, euler, dpm
+    guidance_cutoff: Optional[float] = None  # fraction of steps that use guidance
+    guidance_norm_threshold: Optional[float] = None
+    deep_cache_interval: Optional[int] = None  # fast mode, UNet steps between full passes
+    token_merging_ratio: Optional[float] = None  # fraction of self attention tokens merged
+    # cache key of the result a variation or refine starts from, at `strength`
+    source_key: Optional[str] = None
+    # a draft is rendered at draft_scale of the size with at most draft_steps
+    # steps, mode="refine" with its key as source_key upscales it
+    draft_scale: float = 0.5
+    draft_steps: int = 8
@@ -0,0 +1,111 @@
+# step to step feature caching for the UNet, based on
+# DeepCache: Accelerating Diffusion Models for Free (https://arxiv.org/abs/2312.00858)
+from typing import Optional
+
+import torch
+
+from diffusers.models import UNet2DConditionModel
+
+
+def _has_attentions(block) -> bool:
+    return hasattr(block, "attentions") and block.attentions is not None
+
+
+class DeepCacheUNet:
+    """Runs the UNet and caches the output of its deep blocks.
+
+    Every `interval` steps the full UNet is evaluated and the input of the last
+    (shallowest) up block is kept. The steps in between only run conv_in, the
+    first down block and the last up block on top of the cached features. The
+    wrapped UNet is not modified, so one instance is created per request.
+    """
+
+    def __init__(self, unet: UNet2DConditionModel, interval: int):
+        if interval < 1:
+            raise ValueError(f"The cache interval should be >= 1 but is {interval}")
+        self.unet = unet
+        self.interval = interval
+        self.step = 0
+        self.cached_features: Optional[torch.Tensor] = None
+        self.full_steps = 0
+
+    def _time_embedding(self, sample, timestep):
+        timesteps = timestep
+        if not torch.is_tensor(timesteps):
+            timesteps = torch.tensor([timesteps], dtype=torch.long, device=sample.device)
+        elif len(timesteps.shape) == 0:
+            timesteps = timesteps[None].to(sample.device)
+        timesteps = timesteps.expand(sample.shape[0])
+        t_emb = self.unet.time_proj(timesteps)
+        return self.unet.time_embedding(t_emb)
+
+    def _down(self, block, sample, emb, encoder_hidden_states):
+        if _has_attentions(block):
+            return block(
+                hidden_states=sample,
+                temb=emb,
+                encoder_hidden_states=encoder_hidden_states,
+            )
+        return block(hidden_states=sample, temb=emb)
+
+    def _up(self, block, sample, emb, res_samples, encoder_hidden_states):
+        if _has_attentions(block):
+            return block(
+                hidden_states=sample,
+                temb=emb,
+                res_hidden_states_tuple=res_samples,
+                encoder_hidden_states=encoder_hidden_states,
+            )
+        return block(hidden_states=sample, temb=emb, res_hidden_states_tuple=res_samples)
+
+    def _use_cache(self, sample) -> bool:
+        return (
+            self.cached_features is not None
+            and self.step % self.interval != 0
+            # the batch halves when guidance is truncated
+            and self.cached_features.shape[0] == sample.shape[0]
+        )
+
+    def __call__(self, sample, timestep, encoder_hidden_states):
+        unet = self.unet
+        if unet.config.center_input_sample:
+            sample = 2 * sample - 1.0
+        emb = self._time_embedding(sample, timestep)
+        sample = unet.conv_in(sample)
+        last_up_block = unet.up_blocks[-1]
+        num_skips = len(last_up_block.resnets)
+
+        if self._use_cache(sample):
+            _, res_samples = self._down(
+                unet.down_blocks[0], sample, emb, encoder_hidden_states
+            )
+            skip_samples = ((sample,) + res_samples)[:num_skips]
+            sample = self.cached_features
+        else:
+            down_block_res_samples = (sample,)
+            for block in unet.down_blocks:
+                sample, res_samples = self._down(
+                    block, sample, emb, encoder_hidden_states
+                )
+                down_block_res_samples += res_samples
+            sample = unet.mid_block(
+                sample, emb, encoder_hidden_states=encoder_hidden_states
+            )
+            for block in unet.up_blocks[:-1]:
+                res_samples = down_block_res_samples[-len(block.resnets) :]
+                down_block_res_samples = down_block_res_samples[: -len(block.resnets)]
+                sample = self._up(
+                    block, sample, emb, res_samples, encoder_hidden_states
+                )
+            skip_samples = down_block_res_samples
+            self.cached_features = sample
+            self.full_steps += 1
+
+        sample = self._up(
+            last_up_block, sample, emb, skip_samples, encoder_hidden_states
+        )
+        sample = unet.conv_norm_out(sample)
+        sample = unet.conv_act(sample)
+        sample = unet.conv_out(sample)
+        self.step += 1
+        return {"sample": sample}
@@ -1,7 +1,7 @@
-from dataclasses import asdict
+from dataclasses import asdict, replace
 from torch import autocast
 from PIL import Image
-from typing import List
+from typing import Any, Callable, Iterator, List, Optional
 # from diffusers import StableDiffusionPipeline
 
 import os
@@ -9,7 +9,21 @@ import torch
 import time
 
 from peacasso.datamodel import GeneratorConfig
-from peacasso.pipelines import StableDiffusionPipeline
+from peacasso.pipelines import GenerationCancelled, StableDiffusionPipeline
+
+
+def draft_config(config: GeneratorConfig) -> GeneratorConfig:
+    """The prompt config a mode="draft" config is rendered with, `draft_scale`
+    of the size rounded to multiples of 64 for the UNet, and at most
+    `draft_steps` steps"""
+    data = asdict(config)
+    data.update(
+        mode="prompt",
+        height=max(64, int(config.height * config.draft_scale) // 64 * 64),
+        width=max(64, int(config.width * config.draft_scale) // 64 * 64),
+        num_inference_steps=min(config.draft_steps, config.num_inference_steps),
+    )
+    return GeneratorConfig(**data)
 
 
 class ImageGenerator:
@@ -23,6 +37,7 @@ class ImageGenerator:
     ) -> None:
 
         assert token is not None, "HF_API_TOKEN environment variable must be set."
+        self.model = model
         self.device = f"cuda:{cuda_device}" if torch.cuda.is_available() else "cpu"
         self.pipe = StableDiffusionPipeline.from_pretrained(
             model,
@@ -31,13 +46,44 @@ class ImageGenerator:
             use_auth_token=token,
         ).to(self.device)
 
-    def generate(self, config: GeneratorConfig) -> Image:
-        """Generate image from prompt"""
-        config.prompt = [config.prompt] * config.num_images
+    def generate(
+        self,
+        config: GeneratorConfig,
+        is_cancelled: Optional[Callable[[], bool]] = None,
+        init_latents: Optional[Any] = None,
+    ) -> Image:
+        """Generate image from prompt, `is_cancelled` is checked before every
+        denoising step and raises GenerationCancelled. `init_latents` are the
+        latents of a previous result for mode="variation" or "refine"."""
+        # render from a copy, the caller's config still gives the cache key
+        config = replace(config, prompt=[config.prompt] * config.num_images)
+        if config.mode == "draft":
+            config = draft_config(config)
+        with autocast("cuda" if torch.cuda.is_available() else "cpu"):
+            results = self.pipe(
+                **asdict(config), is_cancelled=is_cancelled, init_latents=init_latents
+            )
+        return results
+
+    def generate_batch(self, configs: List[GeneratorConfig]) -> dict:
+        """Generate one image per config in a single UNet batch. The configs
+        may only differ in their prompt and seed."""
+        config = asdict(configs[0])
+        config["prompt"] = [c.prompt for c in configs]
+        # each image gets the noise of its own seed, as when rendered alone
+        config["seed"] = [c.seed for c in configs]
         with autocast("cuda" if torch.cuda.is_available() else "cpu"):
-            results = self.pipe(**asdict(config))
+            results = self.pipe(**config)
         return results
 
+    def iter_images(self, results: dict) -> Iterator[Image.Image]:
+        """Images of a result, decoded one at a time when it was generated with
+        output_type="latent"."""
+        if results["images"] is not None:
+            yield from results["images"]
+        else:
+            yield from self.pipe.iter_images(results["latents"])
+
     def list_cuda(self) -> List[int]:
         """List available cuda devices
         Returns:
@@ -59,8 +105,13 @@ class FakeImageGenerator:
         cuda_device: int = 0,
     ) -> None:
         self.token = token
+        self.model = None
 
-    def generate(self, config):
+    def generate(self, config, is_cancelled=None, init_latents=None):
+        if is_cancelled is not None and is_cancelled():
+            raise GenerationCancelled("Cancelled")
+        if config.mode == "draft":
+            config = draft_config(config)
         num_images = config.num_images
         width = config.width
         height = config.height
@@ -70,3 +121,12 @@ class FakeImageGenerator:
             images.append(image)
         time.sleep(0.3)
         return dict(images=images)
+
+    def iter_images(self, results):
+        return iter(results["images"])
+
+    def generate_batch(self, configs):
+        images = []
+        for config in configs:
+            images.extend(self.generate(config)["images"][:1])
+        return dict(images=images)
@@ -1,8 +1,7 @@
 # based on
 # https://github.com/huggingface/diffusers/tree/main/src/diffusers/pipelines/stable_diffusion
-import inspect
 import time
-from typing import List, Optional, Union
+from typing import Callable, Iterator, List, Optional, Union
 import PIL
 import torch
 import numpy as np
@@ -22,6 +21,20 @@ from diffusers.pipelines.stable_diffusion.safety_checker import (
     StableDiffusionSafetyChecker,
 )
 
+from peacasso.attention import (
+    AttentionPlanner,
+    apply_attention_planning,
+    attention_slicing,
+)
+from peacasso.deepcache import DeepCacheUNet
+from peacasso.schedulers import SchedulerCache
+from peacasso.token_merging import apply_token_merging, token_merging
+from peacasso import vae as vae_utils
+
+
+class GenerationCancelled(Exception):
+    """Raised between denoising steps when the caller cancelled the generation"""
+
 
 def preprocess(image):
     w, h = image.size
@@ -51,10 +64,23 @@ def decode_image(
     vae,
 ):
     latents = 1 / 0.18215 * latents
-    image = vae.decode(latents.to(vae.dtype)).sample
-    image = (image / 2 + 0.5).clamp(0, 1)
-    image = image.cpu().permute(0, 2, 3, 1).numpy()
-    return image
+    images = []
+    # decode one image at a time so the decoder activations of a batch are
+    # never alive at once
+    for latent in latents.split(1):
+        image = vae_utils.decode(vae, latent.to(vae.dtype))
+        image = (image / 2 + 0.5).clamp(0, 1)
+        images.append(image.cpu().permute(0, 2, 3, 1).numpy())
+    return np.concatenate(images)
+
+
+def randn(shape, generators, device) -> torch.FloatTensor:
+    """Gaussian noise of `shape`, one image at a time from its own generator,
+    so an image of a batch gets the noise it would get when rendered alone"""
+    return torch.cat([
+        torch.randn((1,) + tuple(shape[1:]), generator=generator, device=device)
+        for generator in generators
+    ])
 
 
 class StableDiffusionPipeline(DiffusionPipeline):
@@ -79,6 +105,21 @@ class StableDiffusionPipeline(DiffusionPipeline):
             feature_extractor=feature_extractor,
             safety_checker=safety_checker,
         )
+        self.scheduler_cache = SchedulerCache(self.scheduler)
+        # attention slicing is chosen per call, see __call__
+        apply_attention_planning(self.unet)
+        self.attention_planner = AttentionPlanner(self.unet)
+        # token merging is off unless a request sets token_merging_ratio
+        apply_token_merging(self.unet)
+
+    def iter_images(self, latents) -> Iterator[PIL.Image.Image]:
+        """Decode the latents of an output_type="latent" result one image at a
+        time, only one decoded image is alive at once"""
+        for latent in latents:
+            latent = torch.as_tensor(latent[None]).to(self.device)
+            with torch.no_grad():
+                image = decode_image(latent, self.vae)
+            yield self.numpy_to_pil(image)[0]
 
     @torch.no_grad()
     def __call__(
@@ -94,40 +135,49 @@ class StableDiffusionPipeline(DiffusionPipeline):
         strength: float = 0.8,
         init_image: Union[torch.FloatTensor, PIL.Image.Image] = None,
         return_intermediates: bool = False,
-        seed: Optional[int] = 2147483647,
+        seed: Optional[Union[int, List[Optional[int]]]] = 2147483647,
         attention_slice: Optional[Union[str, int]] = "auto",
         mask_image: Union[torch.FloatTensor, PIL.Image.Image] = None,
+        output_type: Optional[str] = "pil",
+        init_latents: Optional[Union[torch.FloatTensor, np.ndarray]] = None,
+        scheduler: Optional[str] = None,
+        guidance_cutoff: Optional[float] = None,
+        guidance_norm_threshold: Optional[float] = None,
+        deep_cache_interval: Optional[int] = None,
+        token_merging_ratio: Optional[float] = None,
+        is_cancelled: Optional[Callable[[], bool]] = None,
         **kwargs,
     ):
-        if seed is not None:
-            generator = torch.Generator(device=self.device).manual_seed(seed)
-
-        if attention_slice:
-            if attention_slice == "auto":
-                self.unet.set_attention_slice(self.unet.config.attention_head_dim // 2)
-            else:
-                self.unet.set_attention_slice(attention_slice)
         start_time = time.time()
         if isinstance(prompt, str):
             batch_size = 1
         elif isinstance(prompt, list):
-            batch_size = 1 #len(prompt)
+            batch_size = len(prompt)
         else:
             raise ValueError(
                 f"`prompt` has to be of type `str` or `list` but is {type(prompt)}"
             )
+        # a list of seeds has one seed per prompt, the initial noise of each
+        # image is drawn from its own generator
+        generators = None
+        if isinstance(seed, (list, tuple)):
+            if len(seed) != batch_size:
+                raise ValueError(
+                    f"Got {len(seed)} seeds for a batch of {batch_size} prompts."
+                )
+            generators = [
+                torch.Generator(device=self.device).manual_seed(s) if s is not None else None
+                for s in seed
+            ]
+            generator = generators[0]
+        elif seed is not None:
+            generator = torch.Generator(device=self.device).manual_seed(seed)
 
-        # set timesteps
-        accepts_offset = "offset" in set(
-            inspect.signature(self.scheduler.set_timesteps).parameters.keys()
-        )
-        extra_set_kwargs = {}
-        offset = 0
-        if accepts_offset:
-            offset = 1
-            extra_set_kwargs["offset"] = 1
-
-        self.scheduler.set_timesteps(num_inference_steps, **extra_set_kwargs)
+        # timesteps are precomputed per (scheduler, steps) and shared, the
+        # sampling state is private to this call
+        plan = self.scheduler_cache.get(scheduler, num_inference_steps)
+        scheduler_state = plan.new_state(eta=eta, generator=generator)
+        timesteps = scheduler_state.timesteps
 
         if mode == "prompt":
             if height % 8 != 0 or width % 8 != 0:
@@ -135,14 +185,19 @@ class StableDiffusionPipeline(DiffusionPipeline):
                     f"`height` and `width` have to be divisible by 8 but are {height} and {width}."
                 )
             # get the intial random noise
-            latents = torch.randn(
-                (batch_size, self.unet.in_channels, height // 8, width // 8),
-                generator=generator,
-                device=self.device,
-            )
+            shape = (batch_size, self.unet.in_channels, height // 8, width // 8)
+            if generators is not None:
+                latents = randn(shape, generators, self.device)
+            else:
+                latents = torch.randn(shape, generator=generator, device=self.device)
+            latents = latents * scheduler_state.init_noise_sigma
             t_start = 0
-        elif mode == "image":
-            if not init_image:
+        elif mode in ("image", "variation", "refine"):
+            if mode != "image" and init_latents is None:
+                raise ValueError(
+                    f"If `mode` is '{mode}' you have to provide `init_latents`."
+                )
+            if init_latents is None and not init_image:
                 raise ValueError(
                     "If `mode` is 'image' you have to provide an `init_image`."
                 )
@@ -150,13 +205,26 @@ class StableDiffusionPipeline(DiffusionPipeline):
                 raise ValueError(
                     f"The value of strength should in [0.0, 1.0] but is {strength}"
                 )
-            if not isinstance(init_image, torch.FloatTensor):
-                init_image = preprocess(init_image)
-            init_image = init_image.to(self.device)
-            # encode the init image into latents and scale the latents
-            init_latent_dist = self.vae.encode(init_image.to(self.device)).latent_dist
-            init_latents = init_latent_dist.sample(generator=generator)
-            init_latents = 0.18215 * init_latents
+            if init_latents is not None:
+                # latents of a previous result, no PNG decode and no VAE encode
+                if isinstance(init_latents, np.ndarray):
+                    init_latents = torch.from_numpy(init_latents)
+                init_latents = init_latents.to(self.device, dtype=torch.float32)
+                if init_latents.ndim == 3:
+                    init_latents = init_latents[None]
+                size = (height // 8, width // 8)
+                if mode != "image" and tuple(init_latents.shape[-2:]) != size:
+                    # upscale (or downscale) in latent space
+                    init_latents = torch.nn.functional.interpolate(
+                        init_latents, size=size, mode="bicubic", align_corners=False
+                    )
+            else:
+                if not isinstance(init_image, torch.FloatTensor):
+                    init_image = preprocess(init_image)
+                init_image = init_image.to(self.device)
+                # encode the init image into latents and scale the latents
+                init_latents = vae_utils.encode(self.vae, init_image, generator)
+                init_latents = 0.18215 * init_latents
 
             # expand init_latents for batch_size
             init_latents = torch.cat([init_latents] * batch_size)
@@ -174,27 +242,17 @@ class StableDiffusionPipeline(DiffusionPipeline):
                     raise ValueError("The mask and init_image should be the same size!")
 
             # get the original timestep using init_timestep
-            offset = self.scheduler.config.get("steps_offset", 0)
-            init_timestep = int(num_inference_steps * strength) + offset
-            init_timestep = min(init_timestep, num_inference_steps)
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                timesteps = torch.tensor(
-                    [num_inference_steps - init_timestep] * batch_size, dtype=torch.long,
-                    device=self.device)
-            else:
-                timesteps = self.scheduler.timesteps[-init_timestep]
-                timesteps = torch.tensor(
-                    [timesteps] * batch_size,
-                    dtype=torch.long,
-                    device=self.device)
+            init_timestep = min(int(len(timesteps) * strength), len(timesteps))
+            t_start = len(timesteps) - init_timestep
 
             # add noise to latents using the timesteps
-            noise = torch.randn(
-                init_latents.shape, generator=generator, device=self.device
-            )
-            init_latents = self.scheduler.add_noise(init_latents, noise, timesteps).to(self.device)
-            latents = init_latents
-            t_start = max(num_inference_steps - init_timestep + offset, 0)
+            if generators is not None:
+                noise = randn(init_latents.shape, generators, self.device)
+            else:
+                noise = torch.randn(
+                    init_latents.shape, generator=generator, device=self.device
+                )
+            latents = scheduler_state.add_noise(init_latents, noise, t_start)
 
         # get prompt text embeddings
         text_input = self.tokenizer(
@@ -228,55 +286,77 @@ class StableDiffusionPipeline(DiffusionPipeline):
             # to avoid doing two forward passes
             text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
 
-        # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
-        # if isinstance(self.scheduler, LMSDiscreteScheduler):
-        #     latents = latents * self.scheduler.sigmas[0]
-
-        # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
-        # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
-        # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
-        # and should be between [0, 1]
-        accepts_eta = "eta" in set(
-            inspect.signature(self.scheduler.step).parameters.keys()
+        # guidance truncation: the last steps mostly refine detail and barely
+        # move with the unconditional branch, so after `guidance_cutoff` of the
+        # steps (or once the guidance delta is small enough) only the
+        # conditional half of the batch is run
+        if guidance_cutoff is not None and not 0 <= guidance_cutoff <= 1:
+            raise ValueError(
+                f"The value of guidance_cutoff should in [0.0, 1.0] but is {guidance_cutoff}"
+            )
+        guidance_end = len(timesteps)
+        if guidance_cutoff is not None:
+            guidance_end = t_start + round((len(timesteps) - t_start) * guidance_cutoff)
+        guidance_steps = 0
+
+        # the slice size only applies to this call, "auto" picks it from the
+        # size of the attention scores and the free memory
+        attention_plan = self.attention_planner.plan(
+            attention_slice,
+            text_embeddings.shape[0],
+            latents.shape[-2] * 8,
+            latents.shape[-1] * 8,
+            self.unet.dtype,
+            self.device,
         )
-        extra_step_kwargs = {}
-        if accepts_eta:
-            extra_step_kwargs["eta"] = eta
+
+        # fast mode, reuse the deep UNet features for `deep_cache_interval` steps
+        unet = self.unet
+        if deep_cache_interval is not None and deep_cache_interval > 1:
+            unet = DeepCacheUNet(self.unet, deep_cache_interval)
 
         intermediate_images = []
-        for i, t in tqdm(enumerate(self.scheduler.timesteps[t_start:])):
+        for i in tqdm(range(t_start, len(timesteps))):
+            if is_cancelled is not None and is_cancelled():
+                raise GenerationCancelled(f"Cancelled at step {i}")
+            t = timesteps[i]
+            if do_classifier_free_guidance and i >= guidance_end:
+                do_classifier_free_guidance = False
+                text_embeddings = text_embeddings.chunk(2)[1]
             # expand the latents if we are doing classifier free guidance
             latent_model_input = (
                 torch.cat([latents] * 2) if do_classifier_free_guidance else latents
             )
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                sigma = self.scheduler.sigmas[i]
-                latent_model_input = latent_model_input / ((sigma**2 + 1) ** 0.5)
+            latent_model_input = scheduler_state.scale_model_input(latent_model_input, i)
 
             # predict the noise residual
-            noise_pred = self.unet(
-                latent_model_input, t, encoder_hidden_states=text_embeddings
-            )["sample"]
+            with attention_slicing(attention_plan.slice_size), token_merging(
+                token_merging_ratio, latents.shape[-2:]
+            ):
+                noise_pred = unet(
+                    latent_model_input, t, encoder_hidden_states=text_embeddings
+                )["sample"]
 
             # perform guidance
             if do_classifier_free_guidance:
                 noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                noise_pred = noise_pred_uncond + guidance_scale * (
-                    noise_pred_text - noise_pred_uncond
-                )
+                guidance = noise_pred_text - noise_pred_uncond
+                noise_pred = noise_pred_uncond + guidance_scale * guidance
+                guidance_steps += 1
+                if guidance_norm_threshold is not None:
+                    # relative size of the guidance term, stop once it is negligible
+                    guidance_norm = guidance.norm() / noise_pred_text.norm()
+                    if guidance_norm < guidance_norm_threshold:
+                        guidance_end = i + 1
 
             # compute the previous noisy sample x_t -> x_t-1
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                latents = self.scheduler.step(
-                    noise_pred, i, latents, **extra_step_kwargs
-                )["prev_sample"]
-            else:
-                latents = self.scheduler.step(
-                    noise_pred, t, latents, **extra_step_kwargs
-                )["prev_sample"]
+            latents = scheduler_state.step(noise_pred, i, latents)
 
             if mode == "image" and mask_image is not None:
-                init_latents_proper = self.scheduler.add_noise(init_latents_orig, noise, t)
+                # latents are now at the noise level of step i + 1
+                init_latents_proper = scheduler_state.add_noise(
+                    init_latents_orig, noise, i + 1
+                )
                 latents = (init_latents_proper * mask) + (latents * (1 - mask))
 
             if return_intermediates:
@@ -287,6 +367,9 @@ class StableDiffusionPipeline(DiffusionPipeline):
         has_nsfw_concept = None
         if return_intermediates:
             image = intermediate_images[-1]
+        elif output_type == "latent":
+            # decoded by the caller one image at a time, see iter_images
+            image = None
         else:
             image = decode_image(latents, self.vae)
             #safety_cheker_input = self.feature_extractor(
@@ -298,7 +381,10 @@ class StableDiffusionPipeline(DiffusionPipeline):
 
         return {
             "images": image,
+            "latents": latents.cpu().numpy(),
             "nsfw_content_detected": has_nsfw_concept,
             "intermediates": intermediate_images,
+            "guidance_steps": guidance_steps,
+            "attention_plan": attention_plan.to_dict(),
             "time": time.time() - start_time,
         }
@@ -0,0 +1,214 @@
+import abc
+import copy
+import inspect
+import math
+import threading
+from typing import Dict, Optional, Tuple
+
+import torch
+
+from diffusers.schedulers import DDIMScheduler, LMSDiscreteScheduler, PNDMScheduler
+
+
+# schedulers that can be selected per request with GeneratorConfig.scheduler.
+# euler and dpm are few-step samplers built on top of the LMS sigma table.
+SCHEDULERS = ("ddim", "pndm", "lms", "euler", "dpm")
+SIGMA_SCHEDULERS = ("lms", "euler", "dpm")
+
+
+class SchedulerState(abc.ABC):
+    """Per request sampling state. The plan it comes from is shared and read-only."""
+
+    def __init__(self, plan: "SchedulerPlan"):
+        self.plan = plan
+
+    @property
+    def timesteps(self):
+        return self.plan.timesteps
+
+    @property
+    def init_noise_sigma(self) -> float:
+        return 1.0
+
+    def scale_model_input(self, sample, i: int):
+        return sample
+
+    @abc.abstractmethod
+    def step(self, noise_pred, i: int, sample):
+        """The sample of step `i + 1` from the noise predicted at step `i`"""
+
+    def add_noise(self, original, noise, i: int):
+        """Noise `original` to the level of step `i`, len(timesteps) means clean."""
+        if i >= len(self.timesteps):
+            return original
+        timesteps = torch.tensor(
+            [self.timesteps[i]] * original.shape[0],
+            dtype=torch.long,
+            device=original.device,
+        )
+        return self.plan.scheduler.add_noise(original, noise, timesteps)
+
+
+class DiffusersSchedulerState(SchedulerState):
+    """Wraps a private copy of a diffusers scheduler with fresh multistep buffers."""
+
+    def __init__(
+        self,
+        plan: "SchedulerPlan",
+        eta: float = 0.0,
+        generator: Optional[torch.Generator] = None,
+    ):
+        super().__init__(plan)
+        # shallow copy, the precomputed tables are shared, only the step
+        # history (PNDM ets, LMS derivatives) is per request
+        self.scheduler = copy.copy(plan.scheduler)
+        if isinstance(self.scheduler, PNDMScheduler):
+            self.scheduler.ets = []
+            self.scheduler.counter = 0
+            self.scheduler.cur_model_output = 0
+            self.scheduler.cur_sample = None
+        elif isinstance(self.scheduler, LMSDiscreteScheduler):
+            self.scheduler.derivatives = []
+        self.extra_step_kwargs = {}
+        if plan.accepts_eta:
+            self.extra_step_kwargs["eta"] = eta
+        if plan.accepts_generator:
+            self.extra_step_kwargs["generator"] = generator
+
+    def step(self, noise_pred, i: int, sample):
+        return self.scheduler.step(
+            noise_pred, self.timesteps[i], sample, **self.extra_step_kwargs
+        )["prev_sample"]
+
+
+class LMSSchedulerState(DiffusersSchedulerState):
+    @property
+    def init_noise_sigma(self) -> float:
+        return float(self.plan.sigmas[0])
+
+    def scale_model_input(self, sample, i: int):
+        sigma = float(self.plan.sigmas[i])
+        return sample / ((sigma**2 + 1) ** 0.5)
+
+    def step(self, noise_pred, i: int, sample):
+        # LMSDiscreteScheduler indexes its tables by step, not by timestep
+        return self.scheduler.step(noise_pred, i, sample)["prev_sample"]
+
+    def add_noise(self, original, noise, i: int):
+        return original + noise * float(self.plan.sigmas[i])
+
+
+class EulerSchedulerState(LMSSchedulerState):
+    """Euler method on the karras ODE, a single model call per step."""
+
+    def step(self, noise_pred, i: int, sample):
+        sigma, sigma_next = float(self.plan.sigmas[i]), float(self.plan.sigmas[i + 1])
+        return sample + noise_pred * (sigma_next - sigma)
+
+
+class DPMSolverSchedulerState(LMSSchedulerState):
+    """DPM-Solver++(2M), second order multistep, good results from ~15 steps."""
+
+    def __init__(self, plan: "SchedulerPlan", **kwargs):
+        super().__init__(plan, **kwargs)
+        self.old_denoised = None
+
+    def step(self, noise_pred, i: int, sample):
+        sigmas = self.plan.sigmas
+        sigma, sigma_next = float(sigmas[i]), float(sigmas[i + 1])
+        denoised = sample - sigma * noise_pred
+        if sigma_next == 0:
+            prev_sample = denoised
+        else:
+            h = math.log(sigma) - math.log(sigma_next)
+            if self.old_denoised is None:
+                denoised_d = denoised
+            else:
+                h_last = math.log(float(sigmas[i - 1])) - math.log(sigma)
+                r = h_last / h
+                denoised_d = (1 + 1 / (2 * r)) * denoised - (
+                    1 / (2 * r)
+                ) * self.old_denoised
+            prev_sample = (sigma_next / sigma) * sample - math.expm1(-h) * denoised_d
+        self.old_denoised = denoised
+        return prev_sample
+
+
+STATE_CLASSES = {
+    "lms": LMSSchedulerState,
+    "euler": EulerSchedulerState,
+    "dpm": DPMSolverSchedulerState,
+}
+
+
+class SchedulerPlan:
+    """Timestep and sigma tables for one (scheduler, steps) pair, computed once."""
+
+    def __init__(self, name: str, scheduler, num_inference_steps: int):
+        self.name = name
+        self.num_inference_steps = num_inference_steps
+        accepts_offset = "offset" in inspect.signature(scheduler.set_timesteps).parameters
+        if accepts_offset:
+            scheduler.set_timesteps(num_inference_steps, offset=1)
+        else:
+            scheduler.set_timesteps(num_inference_steps)
+        self.scheduler = scheduler
+        self.timesteps = scheduler.timesteps
+        self.sigmas = getattr(scheduler, "sigmas", None)
+        step_params = inspect.signature(scheduler.step).parameters
+        self.accepts_eta = "eta" in step_params
+        self.accepts_generator = "generator" in step_params
+
+    def new_state(
+        self, eta: float = 0.0, generator: Optional[torch.Generator] = None
+    ) -> SchedulerState:
+        if self.name in STATE_CLASSES:
+            return STATE_CLASSES[self.name](self, eta=eta, generator=generator)
+        if isinstance(self.scheduler, LMSDiscreteScheduler):
+            return LMSSchedulerState(self, eta=eta, generator=generator)
+        return DiffusersSchedulerState(self, eta=eta, generator=generator)
+
+
+class SchedulerCache:
+    """Builds scheduler plans from the model's noise schedule and caches them."""
+
+    def __init__(self, default_scheduler):
+        self.default_scheduler = default_scheduler
+        self.plans: Dict[Tuple[Optional[str], int], SchedulerPlan] = {}
+        self.lock = threading.Lock()
+
+    def _beta_kwargs(self) -> dict:
+        config = self.default_scheduler.config
+        return dict(
+            num_train_timesteps=config.get("num_train_timesteps", 1000),
+            beta_start=config.get("beta_start", 0.00085),
+            beta_end=config.get("beta_end", 0.012),
+            beta_schedule=config.get("beta_schedule", "scaled_linear"),
+            tensor_format="pt",
+        )
+
+    def _create(self, name: Optional[str]):
+        if name is None:
+            return copy.deepcopy(self.default_scheduler)
+        if name == "ddim":
+            return DDIMScheduler(
+                clip_sample=False, set_alpha_to_one=False, **self._beta_kwargs()
+            )
+        if name == "pndm":
+            return PNDMScheduler(skip_prk_steps=True, **self._beta_kwargs())
+        if name in SIGMA_SCHEDULERS:
+            return LMSDiscreteScheduler(**self._beta_kwargs())
+        raise ValueError(
+            f"`scheduler` has to be one of {', '.join(SCHEDULERS)} but is {name}"
+        )
+
+    def get(self, name: Optional[str], num_inference_steps: int) -> SchedulerPlan:
+        key = (name, num_inference_steps)
+        plan = self.plans.get(key)
+        if plan is None:
+            with self.lock:
+                plan = self.plans.get(key)
+                if plan is None:
+                    plan = SchedulerPlan(name, self._create(name), num_inference_steps)
+                    self.plans[key] = plan
+        return plan
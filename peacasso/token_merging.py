@@ -0,0 +1,151 @@
+# token merging for the UNet self attention, based on
+# Token Merging for Fast Stable Diffusion (https://arxiv.org/abs/2303.17604)
+# and https://github.com/dbolya/tomesd
+import math
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional, Tuple
+
+import torch
+
+from diffusers.models.attention import BasicTransformerBlock
+
+
+# (ratio, latent height, latent width) of the running request. A context
+# variable keeps concurrent requests on the shared UNet apart.
+_merge_settings: ContextVar[Optional[Tuple[float, int, int]]] = ContextVar(
+    "peacasso_token_merging", default=None
+)
+
+
+def do_nothing(x: torch.Tensor) -> torch.Tensor:
+    return x
+
+
+def bipartite_soft_matching_2d(
+    metric: torch.Tensor, w: int, h: int, sx: int, sy: int, r: int
+) -> Tuple[Callable, Callable]:
+    """Split the tokens into one destination per (sx, sy) cell and the rest,
+    and merge the `r` sources most similar to a destination into it."""
+    B, N, _ = metric.shape
+    if r <= 0:
+        return do_nothing, do_nothing
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+        # the top left token of each cell is the destination
+        idx_buffer_view = torch.zeros(
+            hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64
+        )
+        idx_buffer_view[:, :, 0] = -1
+        idx_buffer_view = (
+            idx_buffer_view.view(hsy, wsx, sy, sx)
+            .transpose(1, 2)
+            .reshape(hsy * sy, wsx * sx)
+        )
+        if (hsy * sy) < h or (wsx * sx) < w:
+            idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            idx_buffer[: (hsy * sy), : (wsx * sx)] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+
+        num_dst = hsy * wsx
+        a_idx = rand_idx[:, num_dst:, :]  # src
+        b_idx = rand_idx[:, :num_dst, :]  # dst
+
+        def split(x):
+            C = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]  # unmerged tokens
+        src_idx = edge_idx[..., :r, :]  # merged tokens
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x: torch.Tensor) -> torch.Tensor:
+        src, dst = split(x)
+        n, t1, c = src.shape
+        unm = torch.gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce="mean")
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x: torch.Tensor) -> torch.Tensor:
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        c = unm.shape[-1]
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        a_expanded = a_idx.expand(B, a_idx.shape[1], 1)
+        out.scatter_(
+            dim=-2,
+            index=torch.gather(a_expanded, dim=1, index=unm_idx).expand(B, unm_len, c),
+            src=unm,
+        )
+        out.scatter_(
+            dim=-2,
+            index=torch.gather(a_expanded, dim=1, index=src_idx).expand(B, r, c),
+            src=src,
+        )
+        return out
+
+    return merge, unmerge
+
+
+def compute_merge(x: torch.Tensor, max_downsample: int = 1) -> Tuple[Callable, Callable]:
+    settings = _merge_settings.get()
+    if settings is None:
+        return do_nothing, do_nothing
+    ratio, original_h, original_w = settings
+    downsample = int(math.ceil(math.sqrt(original_h * original_w // x.shape[1])))
+    # only the high resolution blocks, where attention is quadratic in a lot of tokens
+    if downsample > max_downsample:
+        return do_nothing, do_nothing
+    w = int(math.ceil(original_w / downsample))
+    h = int(math.ceil(original_h / downsample))
+    r = int(x.shape[1] * ratio)
+    return bipartite_soft_matching_2d(x, w, h, 2, 2, r)
+
+
+class ToMeBlock(BasicTransformerBlock):
+    """BasicTransformerBlock that merges tokens before self attention."""
+
+    def forward(self, hidden_states, context=None):
+        merge, unmerge = compute_merge(hidden_states)
+        hidden_states = unmerge(self.attn1(merge(self.norm1(hidden_states)))) + hidden_states
+        hidden_states = self.attn2(self.norm2(hidden_states), context=context) + hidden_states
+        hidden_states = self.ff(self.norm3(hidden_states)) + hidden_states
+        return hidden_states
+
+
+def apply_token_merging(unet: torch.nn.Module) -> int:
+    """Patch the transformer blocks of the UNet, returns the number of patched blocks.
+    The blocks behave as before unless a request sets a merge ratio."""
+    patched = 0
+    for module in unet.modules():
+        if type(module) is BasicTransformerBlock:
+            module.__class__ = ToMeBlock
+            patched += 1
+    return patched
+
+
+@contextmanager
+def token_merging(ratio: Optional[float], latent_size: Tuple[int, int]):
+    """Merge `ratio` of the tokens in the patched blocks for the duration of the block"""
+    if ratio is not None and not 0 <= ratio < 1:
+        raise ValueError(f"The value of token_merging_ratio should in [0.0, 1.0) but is {ratio}")
+    token = _merge_settings.set((ratio, *latent_size) if ratio else None)
+    try:
+        yield
+    finally:
+        _merge_settings.reset(token)
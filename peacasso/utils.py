@@ -1,9 +1,10 @@
 import base64
 import json
-from typing import Any, List
+from typing import Any, Iterable, Iterator, List, Tuple
 import os
 from PIL import Image
 import io
+import zipfile
 
 
 def get_dirs(path: str) -> List[str]:
@@ -24,3 +25,40 @@ def base64_to_pil(base64_string: str) -> Image:
         mask.save("mask.png")
         img.save("img.png")
     return img, mask
+
+
+class _ZipBuffer(io.RawIOBase):
+    """Unseekable sink for ZipFile, `drain` hands out what was written since
+    the last call"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(files: Iterable[Tuple[str, bytes]]) -> Iterator[bytes]:
+    """Zip archive of (name, content) pairs, one chunk per member as soon as
+    it is read from `files` and a last chunk with the central directory.
+    Members are stored, PNG does not deflate any further."""
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for name, content in files:
+            archive.writestr(name, content)
+            yield buffer.drain()
+    yield buffer.drain()
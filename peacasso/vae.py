@@ -0,0 +1,113 @@
+# tiled VAE encode/decode, peak memory depends on the tile size instead of
+# on the output resolution
+from typing import List, Optional
+
+import torch
+
+from diffusers.models import AutoencoderKL
+
+
+VAE_SCALE_FACTOR = 8
+# sizes are in latent pixels, 64 latent pixels are 512 image pixels
+VAE_TILE_SIZE = 64
+VAE_TILE_OVERLAP = 8
+
+
+def _tile_starts(size: int, tile_size: int, overlap: int) -> List[int]:
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, tile_size - overlap))
+    starts.append(size - tile_size)
+    return starts
+
+
+def _blend_mask(height: int, width: int, overlap: int) -> torch.Tensor:
+    """Weights that ramp up linearly over `overlap` pixels from each tile edge"""
+
+    def ramp(n):
+        i = torch.arange(n, dtype=torch.float32)
+        return torch.minimum(i + 1, n - i).clamp(max=overlap) / overlap
+
+    return ramp(height)[:, None] * ramp(width)[None, :]
+
+
+def _tiled(fn, sample, tile_size: int, overlap: int, scale: float):
+    """Apply `fn` to overlapping tiles of `sample` and blend the results.
+    `scale` is the output to input size ratio of `fn`."""
+    batch_size, _, height, width = sample.shape
+    tile_h, tile_w = min(tile_size, height), min(tile_size, width)
+    out_h, out_w = int(height * scale), int(width * scale)
+    out = None
+    weights = torch.zeros(out_h, out_w, device=sample.device)
+    mask = _blend_mask(int(tile_h * scale), int(tile_w * scale), max(int(overlap * scale), 1))
+    mask = mask.to(sample.device)
+    for y in _tile_starts(height, tile_size, overlap):
+        for x in _tile_starts(width, tile_size, overlap):
+            tile = fn(sample[:, :, y : y + tile_h, x : x + tile_w])
+            if out is None:
+                out = torch.zeros(
+                    batch_size, tile.shape[1], out_h, out_w,
+                    device=sample.device, dtype=tile.dtype,
+                )
+            oy, ox = int(y * scale), int(x * scale)
+            region = (slice(oy, oy + tile.shape[2]), slice(ox, ox + tile.shape[3]))
+            out[(..., *region)] += tile * mask.to(tile.dtype)
+            weights[region] += mask
+    return out / weights.to(out.dtype)
+
+
+def needs_tiling(height: int, width: int, tile_size: int = VAE_TILE_SIZE) -> bool:
+    """Tiling switches on once either latent side is larger than one tile"""
+    return height > tile_size or width > tile_size
+
+
+def tiled_decode(
+    vae: AutoencoderKL,
+    latents: torch.FloatTensor,
+    tile_size: int = VAE_TILE_SIZE,
+    overlap: int = VAE_TILE_OVERLAP,
+) -> torch.FloatTensor:
+    return _tiled(
+        lambda tile: vae.decode(tile).sample,
+        latents,
+        tile_size,
+        overlap,
+        VAE_SCALE_FACTOR,
+    )
+
+
+def tiled_encode(
+    vae: AutoencoderKL,
+    image: torch.FloatTensor,
+    generator: Optional[torch.Generator] = None,
+    tile_size: int = VAE_TILE_SIZE,
+    overlap: int = VAE_TILE_OVERLAP,
+) -> torch.FloatTensor:
+    """Encode `image` tile by tile and return sampled (unscaled) latents"""
+    return _tiled(
+        lambda tile: vae.encode(tile).latent_dist.sample(generator=generator),
+        image,
+        tile_size * VAE_SCALE_FACTOR,
+        overlap * VAE_SCALE_FACTOR,
+        1 / VAE_SCALE_FACTOR,
+    )
+
+
+def encode(
+    vae: AutoencoderKL,
+    image: torch.FloatTensor,
+    generator: Optional[torch.Generator] = None,
+) -> torch.FloatTensor:
+    """Encode `image` into latents, tiled above the size threshold"""
+    if needs_tiling(
+        image.shape[2] // VAE_SCALE_FACTOR, image.shape[3] // VAE_SCALE_FACTOR
+    ):
+        return tiled_encode(vae, image, generator)
+    return vae.encode(image).latent_dist.sample(generator=generator)
+
+
+def decode(vae: AutoencoderKL, latents: torch.FloatTensor) -> torch.FloatTensor:
+    """Decode `latents` into images, tiled above the size threshold"""
+    if needs_tiling(*latents.shape[-2:]):
+        return tiled_decode(vae, latents)
+    return vae.decode(latents).sample
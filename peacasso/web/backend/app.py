@@ -1,6 +1,4 @@
-from io import BytesIO
 import io
-import zipfile
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 import os
@@ -10,7 +8,7 @@ from fastapi.responses import StreamingResponse
 from peacasso.datamodel import GeneratorConfig
 import hashlib
 
-from peacasso.utils import base64_to_pil
+from peacasso.utils import base64_to_pil, stream_zip
 
 # # load token from .env variable
 hf_token = os.environ.get("HF_API_TOKEN")
@@ -52,32 +50,29 @@ def generate(prompt_config: GeneratorConfig) -> str:
     # print(prompt_config.init_image)
     if prompt_config.init_image:
         prompt_config.init_image = base64_to_pil(prompt_config.init_image)
+    # the images are decoded while the zip is streamed, one at a time
+    prompt_config.output_type = "latent"
     result = None
     try:
         result = generator.generate(prompt_config)
     except Exception as e:
         return {"status": False, "status_message": str(e)}
-    try:
-        slug = hashlib.sha256(str(prompt_config).encode("utf-8")).hexdigest()
-        zip_io = BytesIO()
-        with zipfile.ZipFile(
-            zip_io, mode="w", compression=zipfile.ZIP_DEFLATED
-        ) as temp_zip:
-            for i, image in enumerate(result["images"]):
-                zip_path = os.path.join("/", str(slug) + "_" + str(i) + ".png")
-                # Add file, at correct path
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format="PNG")
-                image.close()
-                temp_zip.writestr(zip_path, img_byte_arr.getvalue())
-        return StreamingResponse(
-            iter([zip_io.getvalue()]),
-            media_type="application/x-zip-compressed",
-            headers={"Content-Disposition": f"attachment; filename=images.zip"},
-        )
-    except Exception as e:
-        print("error: {}".format(e))
-        return {"status": False, "status_message": str(e)}
+    slug = hashlib.sha256(str(prompt_config).encode("utf-8")).hexdigest()
+
+    def members():
+        for i, image in enumerate(generator.iter_images(result)):
+            zip_path = os.path.join("/", str(slug) + "_" + str(i) + ".png")
+            img_byte_arr = io.BytesIO()
+            image.save(img_byte_arr, format="PNG")
+            image.close()
+            yield zip_path, img_byte_arr.getvalue()
+
+    # errors from here on happen after the response started, they end the stream
+    return StreamingResponse(
+        stream_zip(members()),
+        media_type="application/x-zip-compressed",
+        headers={"Content-Disposition": f"attachment; filename=images.zip"},
+    )
 
 
 @api.get("/cuda")
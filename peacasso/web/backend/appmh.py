@@ -30,6 +30,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Cache-Key"],
 )
 api = FastAPI(root_path="/api")
 app.mount("/api", api)
@@ -65,7 +66,9 @@ def generate(prompt_config: GeneratorConfig) -> str:
             prompt_config.init_image = base64_to_pil(prompt_config.init_image)
         result = None
         try:
-            result = generator.generate(prompt_config)
+            init_latents = cache.source_latents(prompt_config)
+            with cache.rendering():
+                result = generator.generate(prompt_config, init_latents=init_latents)
         except Exception as e:
             print("errorrr: {}".format(e))
             return {"status": False, "status_message": str(e)}
@@ -76,13 +79,21 @@ def generate(prompt_config: GeneratorConfig) -> str:
             pil_image.save(image, format="PNG")
             pil_image.close()
             cache.set(prompt_config, image.getvalue())
+            if "latents" in result:
+                cache.set_latents(prompt_config, result["latents"][prompt_config.image_index])
         except Exception as e:
             print("error: {}".format(e))
             return {"status": False, "status_message": str(e)}
+    # the key the image and its latents are cached under, the source_key of a
+    # variation or refine of this image
+    key = cache.get_key(prompt_config)
     return StreamingResponse(
         iter([image.getvalue()]),
         media_type="image/png",
-        headers={"Content-Disposition": f"attachment; filename=image.png"},
+        headers={
+            "Content-Disposition": f"attachment; filename=image.png",
+            "X-Cache-Key": key,
+        },
     )
 
 
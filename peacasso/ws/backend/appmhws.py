@@ -1,18 +1,22 @@
 import asyncio
 import base64
 import hashlib
+import heapq
 import io
 import itertools
 import json
 import logging
 import os
 import random
+import struct
+import threading
 import time
 import typing as t
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from io import BytesIO
 from queue import Empty, Queue
-from typing import Any, List
+from typing import Any, List, Optional
 from uuid import UUID
 
 import websockets
@@ -20,7 +24,11 @@ from PIL.ImageOps import fit
 from pydantic import BaseModel
 
 from peacasso.cache import cache
-from peacasso.generator import FakeImageGenerator, ImageGenerator
+from peacasso.generator import (
+    FakeImageGenerator,
+    GenerationCancelled,
+    ImageGenerator,
+)
 from peacasso.utils import base64_to_pil
 from peacasso.datamodel import GeneratorConfig
 
@@ -33,69 +41,55 @@ WARNING = "\033[93m"
 
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 
-T = t.TypeVar("T")
-
-
-class OrderedSet(t.MutableSet[T]):
-    """A set that preserves insertion order by internally using a dict.
-    >>> OrderedSet([1, 2, "foo"])
-    """
-
-    __slots__ = ("_d",)
-
-    def __init__(self, iterable: t.Optional[t.Iterable[T]] = None):
-        self._d = dict.fromkeys(iterable) if iterable else {}
-
-    def add(self, x: T) -> None:
-        self._d[x] = None
-
-    def clear(self) -> None:
-        self._d.clear()
-
-    def discard(self, x: T) -> None:
-        self._d.pop(x, None)
-
-    def __getitem__(self, index) -> T:
-        try:
-            return next(itertools.islice(self._d, index, index + 1))
-        except StopIteration:
-            raise IndexError(f"index {index} out of range")
-
-    def __contains__(self, x: object) -> bool:
-        return self._d.__contains__(x)
-
-    def __len__(self) -> int:
-        return self._d.__len__()
-
-    def __iter__(self) -> t.Iterator[T]:
-        return self._d.__iter__()
-
-    def __str__(self):
-        return f"{{{', '.join(str(i) for i in self)}}}"
-
-    def __repr__(self):
-        return f"<OrderedSet {self}>"
-
-
 class WsData(BaseModel):
     id: UUID
     prompt_uuid: UUID
     prompt_config: GeneratorConfig
     created_at: datetime
     website: str
-    image_url: str = None
+    image_url: Optional[str] = None
+    # higher runs first, e.g. interactive requests over bulk ones
+    priority: int = 0
+
+
+# drafts are interactive previews, they run before refines and full renders
+DRAFT_PRIORITY = 10
+
+
+def queue_priority(item: WsData) -> int:
+    priority = item.priority or 0
+    if item.prompt_config.mode == "draft":
+        priority += DRAFT_PRIORITY
+    return priority
 
 
 class WsResponse(BaseModel):
     errors: List[str]
-    data: WsData = None
+    data: Optional[WsData] = None
     action: str
     response_status: int
     request_id: Any = None
+    # job id of a "cancel" action
+    pk: Optional[UUID] = None
 
 
 class WsMessage(BaseModel):
     message: str
+    # result protocol accepted by the server at login, servers that do not
+    # know about binary frames leave it out
+    protocol: Optional[str] = None
+    # the server hands out work on `pull` requests instead of pushing it
+    pull: bool = False
+
+
+class WsCapacity(BaseModel):
+    slots: int
+    free_slots: int
+    queued: int
+    # None until the first job finished
+    seconds_per_step: Optional[float] = None
+    model: Optional[str] = None
+    cache_size: Optional[int] = None
 
 
 class WsAuthResponse(BaseModel):
@@ -106,6 +100,56 @@ class WsAuthResponse(BaseModel):
     request_id: Any = None
 
 
+# last chunk of a complete PNG file
+PNG_END = b"IEND\xaeB`\x82"
+
+PROTOCOL_JSON = "json"
+PROTOCOL_BINARY = "binary"
+# length of the JSON header in front of the image bytes of a binary message
+BINARY_HEADER_LENGTH = struct.Struct("!I")
+
+
+def pack_binary_message(header: dict, payload: bytes) -> bytes:
+    """One binary frame: header length, JSON header, raw image bytes"""
+    header = json.dumps(header).encode()
+    return BINARY_HEADER_LENGTH.pack(len(header)) + header + payload
+
+
+def unpack_binary_message(message: bytes) -> t.Tuple[dict, bytes]:
+    (length,) = BINARY_HEADER_LENGTH.unpack_from(message)
+    start = BINARY_HEADER_LENGTH.size
+    header = json.loads(message[start : start + length])
+    return header, message[start + length :]
+
+
+def result_message(pk, image: bytes, protocol: str = PROTOCOL_JSON, key: str = None):
+    """Build the update message for a generated image. `key` is its cache key,
+    the source_key of a variation or refine of it."""
+    ws_request = {
+        "action": "update",
+        "request_id": time.time(),
+        "pk": str(pk),
+    }
+    if key:
+        ws_request["key"] = key
+    if protocol == PROTOCOL_BINARY:
+        return pack_binary_message(ws_request, image)
+    ws_request["data"] = {"image": base64.b64encode(image).decode()}
+    return json.dumps(ws_request)
+
+
+def failure_message(pk, error: str) -> str:
+    """Tell the dispatcher a job could not be rendered, so it can hand it out
+    again instead of waiting for this worker"""
+    ws_request = {
+        "action": "failed",
+        "request_id": time.time(),
+        "pk": str(pk),
+        "errors": [error],
+    }
+    return json.dumps(ws_request)
+
+
 def satitize_prompt(prompt, length=40):
     prompt = prompt.replace("\n", " ")
     if len(prompt) < length - 3:
@@ -115,28 +159,71 @@ def satitize_prompt(prompt, length=40):
 
 class SetQueue(Queue):
     """
-    Queue with unique items
+    Priority queue with unique items keyed by id. Higher priority first, FIFO
+    within a priority. Replaced and discarded entries stay in the heap marked
+    as removed and are skipped on get, so put, get and discard are O(log n).
+    The queue is unbounded.
     """
 
     def _init(self, maxsize):
-        self.queue = OrderedSet()
+        # heap of [-priority, sequence, id], id is None once removed
+        self.queue = []
+        self.entries = dict()
         self.items = dict()
+        self.counter = itertools.count()
         self.current = None
 
-    def _put(self, item):
-        # print("_put", item.id,  satitize_prompt(item.prompt_config.prompt[:40]), end=" ")
-        if self.current != item.id:
-            self.queue.add(item.id)
-            self.items[item.id] = item
-        #    print("Done")
-        # else:
-        #    print("Rejected")
+    def _qsize(self):
+        return len(self.items)
+
+    def put(self, item, block=True, timeout=None):
+        """Queue `item`, or update the queued item with its id. Only new items
+        are unfinished tasks, so join() returns once they are all done."""
+        with self.not_full:
+            if self._put(item):
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+
+    def _put(self, item) -> bool:
+        """Returns True if `item` was not queued before"""
+        if self.current == item.id:
+            return False
+        priority = -queue_priority(item)
+        self.items[item.id] = item
+        entry = self.entries.get(item.id)
+        if entry is not None:
+            if entry[0] == priority:
+                return False
+            # a duplicate submission updates the priority, keeping its place
+            # among the jobs of the new priority
+            entry[-1] = None
+            entry = [priority, entry[1], item.id]
+            new = False
+        else:
+            entry = [priority, next(self.counter), item.id]
+            new = True
+        self.entries[item.id] = entry
+        heapq.heappush(self.queue, entry)
+        return new
 
     def _get(self):
-        self.current = self.queue.pop()
-        item = self.items.pop(self.current)
-        # print("_get", item.id,  satitize_prompt(item.prompt_config.prompt[:40]))
-        return item
+        pk = None
+        while pk is None:
+            _, _, pk = heapq.heappop(self.queue)
+        del self.entries[pk]
+        self.current = pk
+        return self.items.pop(pk)
+
+    def discard(self, pk) -> bool:
+        """Drop a queued item, returns False if it is not queued"""
+        with self.mutex:
+            if pk not in self.items:
+                return False
+            self.entries.pop(pk)[-1] = None
+            del self.items[pk]
+            self.unfinished_tasks -= 1
+            self.not_full.notify()
+            return True
 
 
 # load token from .env variable
@@ -147,9 +234,13 @@ else:
     generator = FakeImageGenerator(token=hf_token)
 
 
-def generate(prompt_config: GeneratorConfig) -> str:
-    """Generate an image given some prompt"""
+def generate(
+    prompt_config: GeneratorConfig, is_cancelled=None
+) -> t.Tuple[io.BytesIO, bool]:
+    """Generate an image given some prompt, returns the PNG and whether it came
+    from the cache"""
     image = cache.get(prompt_config)
+    cached = bool(image)
     if image:
         image = io.BytesIO(image.read())
     #    time.sleep(random.random() * 3)
@@ -161,7 +252,12 @@ def generate(prompt_config: GeneratorConfig) -> str:
         if prompt_config.init_image:
             prompt_config.init_image = base64_to_pil(prompt_config.init_image)
         result = None
-        result = generator.generate(prompt_config)
+        with cache.rendering():
+            result = generator.generate(
+                prompt_config,
+                is_cancelled=is_cancelled,
+                init_latents=cache.source_latents(prompt_config),
+            )
         pil_image = result["images"][prompt_config.image_index]
         pil_image = fit(
             pil_image, (prompt_config.image_width, prompt_config.image_height)
@@ -170,117 +266,397 @@ def generate(prompt_config: GeneratorConfig) -> str:
         pil_image.save(image, format="PNG")
         pil_image.close()
         cache.set(prompt_config, image.getvalue())
+        if "latents" in result:
+            cache.set_latents(prompt_config, result["latents"][prompt_config.image_index])
     #    time.sleep(random.random() * 3)
         logging.info(
             f"{GREEN}Prompt: {BOLD}%-40s{NC}{GREEN} Created{NC}",
-            satitize_prompt(prompt_config.prompt[0][:40]),
+            satitize_prompt(prompt_config.prompt[:40]),
         )
-    return image
+    return image, cached
+
+
+class WorkerState:
+    """
+    Jobs and finished results that outlive a connection. With a path they are
+    also kept on disk, so a restarted worker picks up where it stopped.
+    """
 
+    def __init__(self, path: str = None, slots: int = 2):
+        self.path = path
+        self.slots = slots
+        self.queue = SetQueue()
+        # results that were not sent yet and their cache keys, by job id
+        self.outbox = dict()
+        self.keys = dict()
+        # cancel events of the jobs being rendered, by job id
+        self.running = dict()
+        # jobs whose render failed and the error, until the dispatcher is told
+        self.failed = dict()
+        self.seconds_per_step = None
+        # set when a slot frees up, wakes the pull loop
+        self.changed = asyncio.Event()
+        # set when a result lands in the outbox, wakes the sender
+        self.finished = asyncio.Event()
+        # one render at a time, whatever happens to the connections
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        if path:
+            os.makedirs(os.path.join(path, "jobs"), exist_ok=True)
+            os.makedirs(os.path.join(path, "results"), exist_ok=True)
+            self._load()
+
+    def _job_path(self, pk) -> str:
+        return os.path.join(self.path, "jobs", f"{pk}.json")
+
+    def _result_path(self, pk, key: str = None) -> str:
+        name = f"{pk}.{key}.png" if key else f"{pk}.png"
+        return os.path.join(self.path, "results", name)
+
+    def _files(self, directory: str, suffix: str) -> t.Iterator[t.Tuple[str, str]]:
+        """(name, path) of the state files in `directory`, temporary files of
+        an interrupted write are removed"""
+        for name in sorted(os.listdir(os.path.join(self.path, directory))):
+            path = os.path.join(self.path, directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+            elif name.endswith(suffix):
+                yield name, path
+
+    def _quarantine(self, path: str, exc: Exception):
+        """Move an unreadable state file aside so the worker still starts"""
+        logging.info(f"{WARNING}Unreadable %s:{NC} %s", path, str(exc))
+        os.replace(path, path + ".bad")
+
+    def _load(self):
+        for name, path in self._files("results", ".png"):
+            try:
+                pk, _, key = name[: -len(".png")].partition(".")
+                pk = UUID(pk)
+                with open(path, "rb") as file:
+                    image = file.read()
+                if not image.endswith(PNG_END):
+                    raise ValueError("truncated PNG")
+            except (OSError, ValueError) as exc:
+                self._quarantine(path, exc)
+                continue
+            self.outbox[pk] = image
+            if key:
+                self.keys[pk] = key
+        for name, path in self._files("jobs", ".json"):
+            try:
+                item = WsData.parse_file(path)
+            except (OSError, ValueError) as exc:
+                self._quarantine(path, exc)
+                continue
+            if item.id not in self.outbox:
+                self.queue.put(item)
+        if self.outbox or self.queue.qsize():
+            logging.info(
+                f"{GREEN}Restored %d jobs and %d results{NC}",
+                self.queue.qsize(),
+                len(self.outbox),
+            )
+
+    def _write(self, path: str, content: bytes):
+        """Write and rename, a crash never leaves a torn file behind"""
+        temp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, "wb") as file:
+            file.write(content)
+        os.replace(temp_file, path)
+
+    def add_job(self, item: WsData):
+        # the server sends the jobs it has not seen a result for again after
+        # a reconnect, including the one being rendered
+        if item.id in self.outbox or item.id in self.failed or item.id in self.running:
+            return
+        self.queue.put(item)
+        if self.path:
+            self._write(self._job_path(item.id), item.json().encode())
+
+    def add_result(self, pk, image: bytes, key: str = None):
+        self.outbox[pk] = image
+        if key:
+            self.keys[pk] = key
+        if self.path:
+            self._write(self._result_path(pk, key), image)
+        self.remove_job(pk)
+
+    def drop_job(self, pk):
+        """The job was reassigned or finished elsewhere"""
+        if self.queue.discard(pk):
+            logging.info(f"{GRAY}Dropped job %s{NC}", pk)
+            self.changed.set()
+        self.remove_job(pk)
+
+    def record_time(self, seconds: float, steps: int):
+        """Moving average of the time per denoising step of actual renders"""
+        per_step = seconds / max(steps or 1, 1)
+        if self.seconds_per_step is None:
+            self.seconds_per_step = per_step
+        else:
+            self.seconds_per_step = 0.8 * self.seconds_per_step + 0.2 * per_step
+
+    def capacity(self) -> WsCapacity:
+        queued = self.queue.qsize()
+        busy = len(self.running)
+        return WsCapacity(
+            slots=self.slots,
+            free_slots=max(self.slots - queued - busy, 0),
+            queued=queued,
+            seconds_per_step=self.seconds_per_step,
+            model=getattr(generator, "model", None),
+            cache_size=cache.size(),
+        )
 
-async def consume(queue, websocket):
+    def cancel(self, pk):
+        """Cancel a queued job, a running job stops at its next denoising step"""
+        if pk in self.running:
+            self.running[pk].set()
+            logging.info(f"{GRAY}Cancelling job %s{NC}", pk)
+        else:
+            self.drop_job(pk)
+
+    def remove_job(self, pk):
+        if self.path and os.path.exists(self._job_path(pk)):
+            os.remove(self._job_path(pk))
+
+    def add_failure(self, pk, error: str):
+        """The job file stays until the failure is sent, a restarted worker
+        tries the job again"""
+        self.failed[pk] = error
+
+    def failure_sent(self, pk):
+        self.failed.pop(pk, None)
+        self.remove_job(pk)
+
+    def result_sent(self, pk):
+        self.outbox.pop(pk, None)
+        path = self.path and self._result_path(pk, self.keys.pop(pk, None))
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+async def flush(state: WorkerState, websocket, protocol: str = PROTOCOL_JSON):
+    """Send the finished results, a result stays in the outbox until it is sent"""
+    for pk in list(state.outbox):
+        await websocket.send(
+            result_message(pk, state.outbox[pk], protocol, state.keys.get(pk))
+        )
+        state.result_sent(pk)
+    for pk in list(state.failed):
+        await websocket.send(failure_message(pk, state.failed[pk]))
+        state.failure_sent(pk)
+
+
+def render(state: WorkerState, item: WsData, cancelled: threading.Event):
+    """Render a job in a worker thread. The result lands in the outbox even if
+    the connection drops in the meantime."""
+    start_time = time.time()
+    try:
+        image, cached = generate(item.prompt_config, is_cancelled=cancelled.is_set)
+        if not cached:
+            state.record_time(
+                time.time() - start_time, item.prompt_config.num_inference_steps
+            )
+        # the key the image and its latents were cached under
+        key = cache.get_key(item.prompt_config)
+        state.add_result(item.id, image.getvalue(), key)
+    except GenerationCancelled:
+        logging.info(f"{GRAY}Cancelled job %s{NC}", item.id)
+        state.remove_job(item.id)
+    except Exception as exc:
+        logging.info(
+            f"{WARNING}An error occurs during image generate:{NC} %s",
+            str(exc),
+        )
+        # tell the dispatcher, or the job stays assigned to this worker
+        state.add_failure(item.id, str(exc))
+    finally:
+        state.running.pop(item.id, None)
+        state.queue.task_done()
+
+
+async def consume(state: WorkerState):
+    """Render the queued jobs one at a time. Runs for the life of the worker,
+    so a render carries on while the connection is down."""
     logging.info(f"{GREEN}Started queue consumer{NC}")
+    queue = state.queue
+    loop = asyncio.get_event_loop()
     while True:
-        await asyncio.sleep(0.01)
         try:
-            item = queue.get(timeout=0.01)
-            image = generate(item.prompt_config)
-            ws_request = {
-                "action": "update",
-                "request_id": time.time(),
-                "pk": str(item.id),
-                "data": {"image": base64.b64encode(image.getvalue()).decode()},
-            }
-            await websocket.send(json.dumps(ws_request))
-            queue.task_done()
+            item = queue.get_nowait()
         except Empty:
+            await asyncio.sleep(0.01)
             continue
-        except KeyboardInterrupt:
-            break
+        cancelled = threading.Event()
+        state.running[item.id] = cancelled
+        # rendering off the event loop keeps the connection responsive, e.g.
+        # to cancel the running job
+        await loop.run_in_executor(state.executor, render, state, item, cancelled)
+        state.changed.set()
+        state.finished.set()
+
+
+async def send_results(state: WorkerState, websocket, protocol: str = PROTOCOL_JSON):
+    """Send the results of this connection as they are rendered, starting with
+    those left over from earlier connections"""
+    logging.info(f"{GREEN}Sending results{NC} (%s)", protocol)
+    while True:
+        state.finished.clear()
+        await flush(state, websocket, protocol)
+        await state.finished.wait()
 
 
-async def main(scheme: str, host: str, port: int, path: str, token: str):
-    if not token:
-        logging.info(f"{WARNING}Empty token, exiting...{NC}")
-        return
-    try:
-        url = f"{scheme}://{host}:{port}{path}"
-        async with websockets.connect(url) as websocket:
-            logging.info(f"{GREEN}Connected to websocket on %s{NC}", url)
+async def pull(state: WorkerState, websocket, interval: float = 5.0):
+    """Ask the dispatcher for work whenever a slot is free. Asks again after
+    `interval` seconds when the dispatcher had nothing to hand out."""
+    while True:
+        state.changed.clear()
+        capacity = state.capacity()
+        if capacity.free_slots:
             ws_request = {
-                "action": "login",
+                "action": "pull",
                 "request_id": time.time(),
-                "token": token,
+                "data": capacity.dict(),
             }
+            await websocket.send(json.dumps(ws_request))
+        try:
+            await asyncio.wait_for(state.changed.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Exponential backoff with full jitter. The exponent is clamped, 2**attempt
+    does not fit in a float once a worker has been offline for hours."""
+    return random.uniform(0, min(cap, base * 2 ** min(attempt, 32)))
+
+
+class LoginRejected(Exception):
+    pass
+
+
+async def login(
+    websocket, token: str, binary: bool = True, capacity: WsCapacity = None
+) -> WsMessage:
+    """Log in and return the negotiated settings"""
+    ws_request = {
+        "action": "login",
+        "request_id": time.time(),
+        "token": token,
+    }
+    if capacity is not None:
+        # dispatchers that balance workers answer with pull=true
+        ws_request["capacity"] = capacity.dict()
+        ws_request["pull"] = True
+    if binary:
+        # servers that accept it answer with protocol=binary
+        ws_request["protocols"] = [PROTOCOL_BINARY, PROTOCOL_JSON]
+    await websocket.send(json.dumps(ws_request))
+    message = await websocket.recv()
+    ws_response = WsAuthResponse(**json.loads(message))
+    if ws_response.response_status != 200:
+        raise LoginRejected(ws_response.data.message)
+    logging.info(f"{GREEN}Login OK{NC}")
+    if not binary or ws_response.data.protocol != PROTOCOL_BINARY:
+        ws_response.data.protocol = PROTOCOL_JSON
+    if capacity is None:
+        ws_response.data.pull = False
+    return ws_response.data
+
+
+async def serve(websocket, state: WorkerState, protocol: str, pull_work: bool = False):
+    """Queue the jobs sent by the server until the connection closes"""
+    tasks = [asyncio.create_task(send_results(state, websocket, protocol))]
+    if pull_work:
+        tasks.append(asyncio.create_task(pull(state, websocket)))
+    try:
+        while True:
+            message = await websocket.recv()
             try:
-                await websocket.send(json.dumps(ws_request))
-                message = await websocket.recv()
-                ws_response = WsAuthResponse(**json.loads(message))
-                if ws_response.response_status != 200:
-                    logging.info(f"{WARNING}%s{NC}", ws_response.data.message)
-                    return
-                logging.info(f"{GREEN}Login OK{NC}")
+                ws_response = WsResponse(**json.loads(message))
+                if ws_response.action == "cancel":
+                    state.cancel(ws_response.pk or ws_response.data.id)
+                    continue
+                # work only on data without assigned image, an image_url means the
+                # job expired or was done by another worker
+                if ws_response.data and ws_response.data.image_url is None:
+                    state.add_job(ws_response.data)
+                elif ws_response.data:
+                    state.drop_job(ws_response.data.id)
             except json.JSONDecodeError as exc:
                 logging.info(
                     f"{WARNING}Invalid JSON data:{NC} %s %s",
                     str(exc),
-                    message_json,
+                    message,
                 )
-                return
             except TypeError as exc:
                 logging.info(f"{WARNING}Invalid data format:{NC} %s", str(exc))
-                return
-            except KeyboardInterrupt:
-                return
-            except websockets.exceptions.ConnectionClosedOK as exc:
+            except Exception as exc:
                 logging.info(
-                    f"{WARNING}Connection Closed:{NC} %s",
+                    f"{WARNING}An error occurs during image generate:{NC} %s\n%s",
                     str(exc),
+                    message
                 )
+            for task in tasks:
+                if task.done():
+                    # surface the task error, the connection is restarted
+                    task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main(
+    scheme: str,
+    host: str,
+    port: int,
+    path: str,
+    token: str,
+    binary: bool = True,
+    state_dir: str = None,
+    max_backoff: float = 60.0,
+    slots: int = 2,
+    pull_work: bool = True,
+):
+    if not token:
+        logging.info(f"{WARNING}Empty token, exiting...{NC}")
+        return
+    url = f"{scheme}://{host}:{port}{path}"
+    state = WorkerState(state_dir, slots=slots)
+    consumer = asyncio.create_task(consume(state))
+    attempt = 0
+    try:
+        while True:
+            try:
+                async with websockets.connect(url) as websocket:
+                    logging.info(f"{GREEN}Connected to websocket on %s{NC}", url)
+                    session = await login(
+                        websocket, token, binary, state.capacity() if pull_work else None
+                    )
+                    attempt = 0
+                    await serve(websocket, state, session.protocol, session.pull)
+            except LoginRejected as exc:
+                logging.info(f"{WARNING}%s{NC}", str(exc))
                 return
-            except Exception as exc:
+            except (ValueError, TypeError) as exc:
+                logging.info(f"{WARNING}Invalid login response:{NC} %s", str(exc))
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as exc:
                 logging.info(
-                    f"{WARNING}An error occurs during image generate:{NC} %s",
+                    f"{WARNING}Connection Closed:{NC} %s",
                     str(exc),
                 )
-                return
-
-            queue = SetQueue()
-            consumer = asyncio.create_task(consume(queue, websocket))
-
-            while True:
-                try:
-                    message = await websocket.recv()
-                    ws_response = WsResponse(**json.loads(message))
-                    # work only on data without assigned image
-                    if ws_response.data and ws_response.data.image_url is None:
-                        queue.put(ws_response.data)
-                except json.JSONDecodeError as exc:
-                    logging.info(
-                        f"{WARNING}Invalid JSON data:{NC} %s %s",
-                        str(exc),
-                        message_json,
-                    )
-                except TypeError as exc:
-                    logging.info(f"{WARNING}Invalid data format:{NC} %s", str(exc))
-                except KeyboardInterrupt:
-                    break
-                except websockets.exceptions.ConnectionClosed as exc:
-                    logging.info(
-                        f"{WARNING}Connection Closed:{NC} %s",
-                        str(exc),
-                    )
-                    break
-                except Exception as exc:
-                    logging.info(
-                        f"{WARNING}An error occurs during image generate:{NC} %s\n%s",
-                        str(exc),
-                        message
-                    )
-            consumer.cancel()
-            await asyncio.gather(consumer, return_exceptions=True)
-    except websockets.exceptions.InvalidHandshake as exc:
-        logging.info(
-            f"{WARNING}Connection Closed:{NC} %s",
-            str(exc),
-        )
+            delay = backoff_delay(attempt, cap=max_backoff)
+            attempt += 1
+            logging.info(
+                f"{WARNING}Reconnecting in %.1fs{NC} (%d jobs queued, %d results unsent)",
+                delay,
+                state.queue.qsize(),
+                len(state.outbox),
+            )
+            await asyncio.sleep(delay)
+    finally:
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+        state.executor.shutdown(wait=False)
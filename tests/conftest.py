@@ -0,0 +1,13 @@
+import os
+
+import pytest
+
+# without a token the backends render with FakeImageGenerator
+os.environ.pop("HF_API_TOKEN", None)
+
+from peacasso.cache import cache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "path", str(tmp_path / "cache"))
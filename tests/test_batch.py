@@ -0,0 +1,96 @@
+import io
+from contextlib import nullcontext
+
+import numpy as np
+from PIL import Image
+
+from peacasso.batch import (
+    BatchRunner,
+    batch_key,
+    encode_image,
+    read_configs,
+    warm_cache,
+)
+from peacasso.benchmarks.models import tiny_pipeline
+from peacasso.cache import FileCache
+from peacasso import generator as generator_module
+from peacasso.datamodel import GeneratorConfig
+from peacasso.generator import FakeImageGenerator, ImageGenerator
+
+
+def test_batched_image_matches_single_render():
+    pipe = tiny_pipeline()
+    kwargs = dict(height=128, width=128, num_inference_steps=5, attention_slice=None)
+    prompts = ["a sea lion", "a lighthouse"]
+    batch = pipe(prompts, seed=[1, 2], **kwargs)["latents"]
+    for prompt, seed, latents in zip(prompts, [1, 2], batch):
+        single = pipe(prompt, seed=seed, **kwargs)["latents"][0]
+        assert np.abs(single - latents).max() < 1e-3
+
+
+def test_batch_key():
+    config = GeneratorConfig(prompt="a", seed=1)
+    assert batch_key(config) == batch_key(GeneratorConfig(prompt="b", seed=2))
+    assert batch_key(config) != batch_key(GeneratorConfig(prompt="b", guidance_scale=5))
+    # step noise and the guidance norm are batch wide
+    assert batch_key(GeneratorConfig(prompt="a", eta=0.5)) is None
+    assert batch_key(GeneratorConfig(prompt="a", guidance_norm_threshold=0.1)) is None
+
+
+def test_read_configs_skips_invalid_lines(tmp_path, capsys):
+    path = tmp_path / "configs.jsonl"
+    path.write_text('{"prompt": "a"}\n{"prompt": \n\n{"num_images": 1}\n{"prompt": "b"}\n')
+    configs = list(read_configs(str(path)))
+    assert [(n, c.prompt) for n, c in configs] == [(0, "a"), (4, "b")]
+    assert "line 1" in capsys.readouterr().out
+
+
+def test_warm_cache_renders_pruned_entries_when_idle(tmp_path):
+    cache = FileCache(str(tmp_path))
+    config = GeneratorConfig(prompt="a")
+    cache.set(config, b"png")
+    cache.get(config).close()
+    cache.remove(cache.get_key(config))
+
+    # a worker rendered just now, the deadline passes first
+    with cache.rendering():
+        pass
+    assert warm_cache(FakeImageGenerator(), cache, max_seconds=0.5, idle_seconds=10) == 0
+    assert warm_cache(FakeImageGenerator(), cache, idle_seconds=0) == 1
+    with cache.get(config) as file:
+        assert file.read().startswith(b"\x89PNG")
+
+
+def test_single_render_stores_the_requested_image(tmp_path, monkeypatch):
+    # cpu autocast runs the tiny model in bfloat16
+    monkeypatch.setattr(generator_module, "autocast", lambda device: nullcontext())
+    generator = ImageGenerator.__new__(ImageGenerator)
+    generator.pipe = tiny_pipeline()
+    cache = FileCache(str(tmp_path / "cache"))
+    # eta != 0 is rendered on its own, not batched
+    config = GeneratorConfig(
+        prompt="a sea lion",
+        num_images=2,
+        image_index=1,
+        height=64,
+        width=64,
+        num_inference_steps=2,
+        eta=0.5,
+    )
+    runner = BatchRunner(generator, str(tmp_path / "first"), cache)
+    runner.add(0, config)
+    runner.finish()
+    assert config.prompt == "a sea lion"
+
+    images = [
+        np.asarray(Image.open(io.BytesIO(encode_image(image, config))), dtype=float)
+        for image in generator.generate(config)["images"]
+    ]
+    with cache.get(config) as file:
+        cached = np.asarray(Image.open(file), dtype=float)
+    assert np.abs(cached - images[1]).mean() < np.abs(cached - images[0]).mean()
+    # a second run is served from the cache
+    runner = BatchRunner(generator, str(tmp_path / "second"), cache)
+    runner.add(0, config)
+    runner.finish()
+    assert runner.stats["cached"] == 1
@@ -0,0 +1,13 @@
+import sys
+
+from peacasso.benchmarks import web
+from peacasso.generator import FakeImageGenerator
+
+
+def test_ws_benchmarks_stay_offline(monkeypatch):
+    # with a token the worker would load the real model at import
+    monkeypatch.setenv("HF_API_TOKEN", "token")
+    monkeypatch.delitem(sys.modules, "peacasso.ws.backend.appmhws", raising=False)
+    results = web.bench_ws_messages(quick=True)
+    assert results["bytes_saved"] > 0
+    assert isinstance(sys.modules["peacasso.ws.backend.appmhws"].generator, FakeImageGenerator)
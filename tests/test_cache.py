@@ -0,0 +1,97 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from peacasso.cache import FileCache
+from peacasso.datamodel import GeneratorConfig
+
+
+def key(**kwargs) -> str:
+    return FileCache("unused").get_key(GeneratorConfig(prompt="a", **kwargs))
+
+
+def test_keys_of_prompt_configs_are_stable():
+    # the key of a plain prompt config is the one it had before fields were added
+    assert key() == "c71c7818-89e1-5d2c-8360-2a7d010d178f"
+
+
+def test_source_configs_have_their_own_keys():
+    keys = [
+        key(mode="refine", source_key="k"),
+        key(mode="variation", source_key="k"),
+        key(mode="variation", source_key="k", height=256, width=256),
+        key(mode="draft"),
+        key(mode="draft", height=1024, width=1024),
+        key(),
+    ]
+    assert len(set(keys)) == len(keys)
+
+
+def test_variations_are_keyed_by_seed():
+    source = key()
+    assert key(mode="variation", source_key=source, seed=1) != key(
+        mode="variation", source_key=source, seed=2
+    )
+    # the seed of a plain prompt config stays out of its key
+    assert key(seed=1) == key()
+
+
+def test_source_key_must_be_a_cache_key(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"))
+    outside = tmp_path / "outside"
+    with open(f"{outside}.latents", "wb") as file:
+        np.save(file, np.zeros(4))
+    for source_key in ("../outside", str(outside), "k", None):
+        config = GeneratorConfig(prompt="a", mode="variation", source_key=source_key)
+        with pytest.raises(ValueError):
+            cache.source_latents(config)
+
+    config = GeneratorConfig(prompt="a")
+    cache.set_latents(config, np.ones((4, 8, 8)))
+    variation = GeneratorConfig(prompt="a", mode="variation", source_key=cache.get_key(config))
+    assert cache.source_latents(variation).shape == (4, 8, 8)
+
+
+def test_prune_counts_shared_blobs_once(tmp_path):
+    cache = FileCache(str(tmp_path))
+    shared, own = b"s" * 1000, b"o" * 500
+    for created, (prompt, content) in enumerate([("a", shared), ("b", shared), ("c", own)]):
+        config = GeneratorConfig(prompt=prompt)
+        cache.set(config, content)
+        cache.index.execute(
+            "UPDATE entries SET created = ? WHERE key = ?", (created, cache.get_key(config))
+        )
+    assert cache.dedup_stats()["stored_size"] == 1500
+
+    # "a" frees nothing while "b" links to the same blob
+    assert cache.prune(max_size=1200) == dict(removed=2, freed=1000)
+    assert cache.dedup_stats()["stored_size"] == 500
+    with cache.get(GeneratorConfig(prompt="c")) as file:
+        assert file.read() == own
+
+
+def test_warming_waits_for_idle_workers(tmp_path):
+    cache = FileCache(str(tmp_path))
+    soon = lambda: time.time() + 0.3
+    with cache.rendering():
+        assert cache.wait_idle(0, soon(), poll=0.05) is None
+    # a worker rendered just now
+    assert cache.wait_idle(10, soon(), poll=0.05) is None
+
+    lock = cache.wait_idle(0, soon(), poll=0.05)
+    assert lock is not None
+    rendered = threading.Event()
+
+    def render():
+        with cache.rendering():
+            rendered.set()
+
+    worker = threading.Thread(target=render)
+    worker.start()
+    # the worker waits for the warm render
+    assert not rendered.wait(0.2)
+    lock.close()
+    assert rendered.wait(5)
+    worker.join()
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from peacasso.benchmarks.models import tiny_pipeline
+from peacasso.deepcache import DeepCacheUNet
+
+
+@pytest.fixture(scope="module")
+def unet():
+    return tiny_pipeline().unet
+
+
+def inputs(unet, batch_size: int, seed: int = 0):
+    generator = torch.manual_seed(seed)
+    sample = torch.randn(batch_size, 4, 8, 8, generator=generator)
+    hidden_states = torch.randn(
+        batch_size, 77, unet.config.cross_attention_dim, generator=generator
+    )
+    return sample, hidden_states
+
+
+@torch.no_grad()
+def test_interval_one_matches_the_unet(unet):
+    cached = DeepCacheUNet(unet, interval=1)
+    for step, timestep in enumerate((900, 500, 100)):
+        sample, hidden_states = inputs(unet, 2, seed=step)
+        expected = unet(sample, timestep, encoder_hidden_states=hidden_states)["sample"]
+        output = cached(sample, timestep, hidden_states)["sample"]
+        assert torch.allclose(output, expected, atol=1e-5)
+    assert cached.full_steps == 3
+
+
+@torch.no_grad()
+def test_batch_size_change_forces_a_full_pass(unet):
+    cached = DeepCacheUNet(unet, interval=3)
+    for step, timestep in enumerate((900, 800)):
+        sample, hidden_states = inputs(unet, 2, seed=step)
+        cached(sample, timestep, hidden_states)
+    # the second step reused the deep features
+    assert cached.full_steps == 1
+
+    # guidance truncation drops the unconditional half of the batch
+    sample, hidden_states = inputs(unet, 1, seed=2)
+    expected = unet(sample, 700, encoder_hidden_states=hidden_states)["sample"]
+    output = cached(sample, 700, hidden_states)["sample"]
+    assert cached.full_steps == 2
+    assert torch.allclose(output, expected, atol=1e-5)
@@ -0,0 +1,66 @@
+import pytest
+import torch
+
+from peacasso.benchmarks.models import tiny_pipeline
+from peacasso.schedulers import SCHEDULERS
+
+
+@pytest.fixture(scope="module")
+def pipe():
+    return tiny_pipeline()
+
+
+def noise_pred(pipe, state, i, sample):
+    """The UNet prediction for `sample` at step `i`, with a fixed text embedding"""
+    torch.manual_seed(0)
+    embeddings = torch.randn(1, 77, pipe.unet.config.cross_attention_dim)
+    model_input = state.scale_model_input(sample, i)
+    with torch.no_grad():
+        return pipe.unet(
+            model_input, state.timesteps[i], encoder_hidden_states=embeddings
+        )["sample"]
+
+
+@pytest.mark.parametrize("name", SCHEDULERS)
+def test_interleaved_states_match_sequential_runs(pipe, name):
+    plan = pipe.scheduler_cache.get(name, 6)
+    starts = [
+        torch.randn(1, 4, 8, 8, generator=torch.manual_seed(seed)) for seed in (1, 2)
+    ]
+
+    sequential = []
+    for start in starts:
+        state = plan.new_state()
+        sample = start * state.init_noise_sigma
+        for i in range(len(state.timesteps)):
+            sample = state.step(noise_pred(pipe, state, i, sample), i, sample)
+        sequential.append(sample)
+
+    states = [plan.new_state(), plan.new_state()]
+    samples = [start * state.init_noise_sigma for start, state in zip(starts, states)]
+    for i in range(len(plan.timesteps)):
+        for n, state in enumerate(states):
+            sample = samples[n]
+            samples[n] = state.step(noise_pred(pipe, state, i, sample), i, sample)
+
+    for interleaved, expected in zip(samples, sequential):
+        assert torch.allclose(interleaved, expected)
+
+
+@pytest.mark.parametrize("name", ["euler", "dpm"])
+def test_few_step_schedulers_finish_with_finite_latents(pipe, name):
+    latents = pipe(
+        "a sea lion",
+        height=64,
+        width=64,
+        num_inference_steps=5,
+        scheduler=name,
+        attention_slice=None,
+        output_type="latent",
+    )["latents"]
+    assert torch.isfinite(torch.from_numpy(latents)).all()
+
+
+def test_unknown_scheduler_raises(pipe):
+    with pytest.raises(ValueError):
+        pipe("a sea lion", height=64, width=64, num_inference_steps=2, scheduler="unknown")
@@ -0,0 +1,17 @@
+import numpy as np
+
+from peacasso.benchmarks.models import tiny_pipeline
+from peacasso.token_merging import ToMeBlock
+
+
+def test_pipeline_patches_its_transformer_blocks():
+    # built directly, not through ImageGenerator
+    pipe = tiny_pipeline()
+    assert any(isinstance(module, ToMeBlock) for module in pipe.unet.modules())
+
+    kwargs = dict(height=128, width=128, num_inference_steps=2, attention_slice=None)
+    plain = pipe("a sea lion", output_type="latent", **kwargs)["latents"]
+    merged = pipe(
+        "a sea lion", output_type="latent", token_merging_ratio=0.5, **kwargs
+    )["latents"]
+    assert not np.allclose(plain, merged)
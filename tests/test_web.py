@@ -0,0 +1,15 @@
+from fastapi.testclient import TestClient
+
+from peacasso.cache import cache
+from peacasso.datamodel import GeneratorConfig
+from peacasso.web.backend.appmh import app
+
+
+def test_generate_returns_cache_key():
+    client = TestClient(app)
+    for _ in range(2):  # rendered, then cached
+        response = client.post("/api/generate", json=dict(prompt="a", seed=1))
+        assert response.headers["content-type"] == "image/png"
+        assert response.headers["x-cache-key"] == cache.get_key(
+            GeneratorConfig(prompt="a", seed=1)
+        )
@@ -0,0 +1,367 @@
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+import pytest
+import websockets
+
+from peacasso.cache import cache
+from peacasso.datamodel import GeneratorConfig
+from peacasso.generator import FakeImageGenerator
+from peacasso.ws.backend import appmhws
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def job(pk: str, image_url: str = None) -> dict:
+    return dict(
+        errors=[],
+        action="create",
+        response_status=200,
+        data=dict(
+            id=pk,
+            prompt_uuid=str(uuid.uuid4()),
+            prompt_config=dict(prompt=f"test job {pk}", num_inference_steps=5),
+            created_at=datetime.now().isoformat(),
+            website="test",
+            image_url=image_url,
+        ),
+    )
+
+
+class Dispatcher:
+    """Stand-in dispatcher, hands out `jobs` one per free slot on pull requests
+    and records what the worker sends back"""
+
+    def __init__(self, jobs, expected=None):
+        self.pending = list(jobs)
+        self.expected = set(expected if expected is not None else jobs)
+        self.logins = []
+        self.pulls = []
+        self.results = {}
+        self.keys = {}
+        self.failures = {}
+        self.done = asyncio.Event()
+
+    async def handler(self, websocket, path=None):
+        async for message in websocket:
+            if isinstance(message, bytes):
+                header, _ = appmhws.unpack_binary_message(message)
+            else:
+                header = json.loads(message)
+            await self.on_message(websocket, header)
+
+    async def on_message(self, websocket, header: dict):
+        if header["action"] == "login":
+            self.logins.append(header)
+            protocol = appmhws.PROTOCOL_BINARY if header.get("protocols") else None
+            await websocket.send(json.dumps(dict(
+                errors=[],
+                action="login",
+                response_status=200,
+                data=dict(message="ok", protocol=protocol, pull=True),
+            )))
+        elif header["action"] == "pull":
+            self.pulls.append(header["data"])
+            for _ in range(header["data"]["free_slots"]):
+                if not self.pending:
+                    break
+                await self.hand_out(websocket, self.pending.pop(0))
+        elif header["action"] == "update":
+            self.results[header["pk"]] = self.results.get(header["pk"], 0) + 1
+            self.keys[header["pk"]] = header.get("key")
+        elif header["action"] == "failed":
+            self.failures[header["pk"]] = header["errors"]
+        if self.expected <= set(self.results) | set(self.failures):
+            self.done.set()
+
+    async def hand_out(self, websocket, pk: str):
+        await websocket.send(json.dumps(job(pk)))
+
+    async def run(self, timeout: float = 30, linger: float = 0, **kwargs):
+        """Run a worker until the expected results are in, and `linger` seconds
+        longer to catch results that should not come"""
+        port = free_port()
+        async with websockets.serve(self.handler, "127.0.0.1", port):
+            worker = asyncio.create_task(appmhws.main(
+                "ws", "127.0.0.1", port, "/", token="test", max_backoff=0.1, **kwargs
+            ))
+            try:
+                await asyncio.wait_for(self.done.wait(), timeout)
+                await asyncio.sleep(linger)
+            finally:
+                worker.cancel()
+                await asyncio.gather(worker, return_exceptions=True)
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_pull_dispatcher(binary):
+    jobs = [str(uuid.uuid4()) for _ in range(5)]
+    dispatcher = Dispatcher(jobs)
+    asyncio.run(dispatcher.run(binary=binary, slots=2))
+
+    assert set(dispatcher.results) == set(jobs)
+    for pk in jobs:
+        config = appmhws.WsData(**job(pk)["data"]).prompt_config
+        assert dispatcher.keys[pk] == cache.get_key(config)
+    capacity = dispatcher.logins[0]["capacity"]
+    assert capacity["slots"] == 2
+    assert capacity["free_slots"] == 2
+    assert capacity["seconds_per_step"] is None
+    assert all(pull["free_slots"] <= 2 for pull in dispatcher.pulls)
+    # later pulls report the measured time per step
+    assert any(pull["seconds_per_step"] for pull in dispatcher.pulls)
+
+
+def test_expired_job_is_dropped():
+    first, expired = str(uuid.uuid4()), str(uuid.uuid4())
+
+    class ExpiringDispatcher(Dispatcher):
+        async def hand_out(self, websocket, pk):
+            await websocket.send(json.dumps(job(first)))
+            await websocket.send(json.dumps(job(expired)))
+            # rendered by another worker while it waited behind `first`
+            await websocket.send(json.dumps(job(expired, image_url="/done.png")))
+
+    dispatcher = ExpiringDispatcher([first], expected=[first])
+    asyncio.run(dispatcher.run(slots=1, linger=1))
+    assert set(dispatcher.results) == {first}
+
+
+def test_torn_state_files_are_quarantined(tmp_path):
+    state_dir = tmp_path / "state"
+    state = appmhws.WorkerState(str(state_dir))
+    state.add_job(appmhws.WsData(**job(str(uuid.uuid4()))["data"]))
+    assert not list(state_dir.rglob("*.tmp"))
+    # a crash in the middle of writing a job and a result
+    (state_dir / "jobs" / f"{uuid.uuid4()}.json").write_text('{"id": "')
+    (state_dir / "results" / f"{uuid.uuid4()}.png").write_bytes(b"\x89PNG\r\n")
+    (state_dir / "jobs" / f"{uuid.uuid4()}.json.1.2.tmp").write_text("{")
+
+    restored = appmhws.WorkerState(str(state_dir))
+    assert restored.queue.qsize() == 1
+    assert not restored.outbox
+    assert len(list(state_dir.rglob("*.bad"))) == 2
+    assert not list(state_dir.rglob("*.tmp"))
+
+
+class CountingGenerator(FakeImageGenerator):
+    """Counts the renders per prompt and the renders running at once"""
+
+    def __init__(self):
+        super().__init__()
+        self.renders = Counter()
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def generate(self, config, **kwargs):
+        with self.lock:
+            self.renders[config.prompt] += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            return super().generate(config, **kwargs)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class KillingDispatcher(Dispatcher):
+    """Aborts every connection `lifetime` seconds after it was opened and, like
+    the real dispatcher, hands out the jobs without a result again at login"""
+
+    def __init__(self, jobs, lifetime: float):
+        super().__init__(jobs)
+        self.lifetime = lifetime
+        self.assigned = []
+        self.connections = 0
+
+    async def handler(self, websocket, path=None):
+        self.connections += 1
+        loop = asyncio.get_running_loop()
+        kill = loop.call_later(self.lifetime, websocket.transport.abort)
+        try:
+            await super().handler(websocket)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            kill.cancel()
+
+    async def on_message(self, websocket, header: dict):
+        await super().on_message(websocket, header)
+        if header["action"] == "login":
+            for pk in self.assigned:
+                if pk not in self.results:
+                    await websocket.send(json.dumps(job(pk)))
+
+    async def hand_out(self, websocket, pk: str):
+        self.assigned.append(pk)
+        await super().hand_out(websocket, pk)
+
+
+def test_no_lost_jobs_when_connections_drop(monkeypatch):
+    generator = CountingGenerator()
+    monkeypatch.setattr(appmhws, "generator", generator)
+    jobs = [str(uuid.uuid4()) for _ in range(8)]
+    dispatcher = KillingDispatcher(jobs, lifetime=0.5)
+    asyncio.run(dispatcher.run(timeout=60, slots=2))
+
+    assert set(dispatcher.results) == set(jobs)
+    assert dispatcher.connections > 2
+    # jobs sent again while queued, rendering or unsent are rendered once
+    assert set(generator.renders.values()) == {1}
+    assert generator.max_running == 1
+
+
+def test_unsent_results_keep_their_cache_key(tmp_path):
+    state_dir = str(tmp_path / "state")
+    pk = uuid.uuid4()
+    appmhws.WorkerState(state_dir).add_result(pk, b"png" + appmhws.PNG_END, "key")
+    restored = appmhws.WorkerState(state_dir)
+    assert restored.keys[pk] == "key"
+    restored.result_sent(pk)
+    assert not os.listdir(os.path.join(state_dir, "results"))
+
+
+def test_capacity_reports_the_current_cache_size():
+    state = appmhws.WorkerState()
+    assert state.capacity().cache_size == 0
+    cache.set(GeneratorConfig(prompt="a"), b"png")
+    assert state.capacity().cache_size == 1
+
+
+def test_cache_hits_do_not_count_as_render_time():
+    state = appmhws.WorkerState()
+    data = job(str(uuid.uuid4()))["data"]
+    for pk in (data["id"], str(uuid.uuid4())):
+        state.queue.put(appmhws.WsData(**dict(data, id=pk)))
+        appmhws.render(state, state.queue.get(), threading.Event())
+        if pk == data["id"]:
+            rendered = state.seconds_per_step
+    assert len(state.outbox) == 2
+    assert state.seconds_per_step == rendered
+
+
+class FailingGenerator(FakeImageGenerator):
+    def generate(self, config, **kwargs):
+        raise RuntimeError("out of memory")
+
+
+def test_failed_render_is_reported(monkeypatch, tmp_path):
+    monkeypatch.setattr(appmhws, "generator", FailingGenerator())
+    pk = str(uuid.uuid4())
+    dispatcher = Dispatcher([pk])
+    state_dir = str(tmp_path / "state")
+    asyncio.run(dispatcher.run(slots=1, linger=0.5, state_dir=state_dir))
+
+    assert dispatcher.failures == {pk: ["out of memory"]}
+    assert not dispatcher.results
+    assert not os.listdir(os.path.join(state_dir, "jobs"))
+
+
+def test_backoff_delay_is_capped_for_large_attempts():
+    for attempt in (0, 5, 1024, 10**6):
+        assert 0 <= appmhws.backoff_delay(attempt, cap=60) <= 60
+
+
+def item(pk: str = None, priority: int = 0) -> appmhws.WsData:
+    data = job(pk or str(uuid.uuid4()))["data"]
+    return appmhws.WsData(**dict(data, priority=priority))
+
+
+def drain(queue: appmhws.SetQueue) -> list:
+    items = []
+    while queue.qsize():
+        items.append(queue.get_nowait())
+        queue.task_done()
+    return items
+
+
+def test_queue_orders_by_priority_then_fifo():
+    queue = appmhws.SetQueue()
+    items = [item(priority=p) for p in (0, 5, 0, 5)]
+    for queued in items:
+        queue.put(queued)
+    assert drain(queue) == [items[1], items[3], items[0], items[2]]
+
+
+def test_duplicate_put_updates_the_priority_in_place():
+    queue = appmhws.SetQueue()
+    first, second, third = item(), item(), item()
+    for queued in (first, second, third):
+        queue.put(queued)
+    queue.put(first)
+    queue.put(item(str(third.id), priority=5))
+    assert queue.qsize() == 3
+    assert [queued.id for queued in drain(queue)] == [third.id, first.id, second.id]
+    # duplicates are not extra tasks
+    assert queue.unfinished_tasks == 0
+    queue.join()
+
+
+def test_discard_and_cancel_queued_jobs(tmp_path):
+    state = appmhws.WorkerState(str(tmp_path / "state"))
+    discarded, cancelled, kept = item(), item(), item()
+    for queued in (discarded, cancelled, kept):
+        state.add_job(queued)
+    # reassigned to another worker
+    state.drop_job(discarded.id)
+    assert not state.queue.discard(discarded.id)
+    state.cancel(cancelled.id)
+
+    assert drain(state.queue) == [kept]
+    assert os.listdir(tmp_path / "state" / "jobs") == [f"{kept.id}.json"]
+    state.queue.join()
+
+
+class SteppingGenerator(FakeImageGenerator):
+    """Checks is_cancelled before every step, like the pipeline"""
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.steps = 0
+
+    def generate(self, config, is_cancelled=None, init_latents=None):
+        self.started.set()
+        for _ in range(config.num_inference_steps):
+            if is_cancelled is not None and is_cancelled():
+                raise appmhws.GenerationCancelled("Cancelled")
+            self.steps += 1
+            time.sleep(0.05)
+        return super().generate(config)
+
+
+def test_cancel_stops_a_running_job_at_the_next_step(monkeypatch, tmp_path):
+    generator = SteppingGenerator()
+    monkeypatch.setattr(appmhws, "generator", generator)
+    state = appmhws.WorkerState(str(tmp_path / "state"))
+    running = item()
+    running.prompt_config.num_inference_steps = 100
+    state.add_job(running)
+
+    cancelled = threading.Event()
+    state.running[running.id] = cancelled
+    thread = threading.Thread(
+        target=appmhws.render, args=(state, state.queue.get(), cancelled)
+    )
+    thread.start()
+    generator.started.wait(5)
+    state.cancel(running.id)
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert generator.steps < 100
+    assert not state.outbox and not state.failed
+    assert not os.listdir(tmp_path / "state" / "jobs")